@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+"""Build several projects at once, with the batch command of process-video.py.
+
+./scripts/batch-videos.py --use-original projects/*.yml
+
+"""
+
+import importlib.util
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_process_video():
+    spec = importlib.util.spec_from_file_location(
+        "process_video", os.path.join(HERE, "process-video.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    # The workers of the batch unpickle the actions of the jobs from the module
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+if __name__ == "__main__":
+    load_process_video().batch(obj={})
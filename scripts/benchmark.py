@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+"""Benchmark process-video.py on synthetic projects.
+
+The projects are generated offline, with ffmpeg's testsrc2 and sine sources,
+so that runs on different machines and commits are comparable.
+
+"""
+
+import datetime
+import glob
+import json
+import os
+import random
+import re
+import shutil
+import statistics
+import subprocess
+import time
+
+import click
+import yaml
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PROCESS_VIDEO = os.path.join(HERE, "process-video.py")
+FONTS = {"Ubuntu-R.ttf": "sans", "UbuntuMono-B.ttf": "monospace:bold"}
+FFMPEG_CMD = ["ffmpeg", "-y", "-v", "error"]
+STEPS = ["process-clips", "combine-clips", "make-trailer"]
+# Resolutions and frame rates of the phone recordings and their proxies
+SCENARIOS = {
+    "low-res": {"size": "960x540", "frame_rate": 30, "sources": 2, "duration": 90, "clips": 4},
+    "hd": {"size": "1920x1080", "frame_rate": 30, "sources": 2, "duration": 180, "clips": 6},
+}
+QUESTIONS = [
+    "How did you start playing Ultimate?",
+    "What keeps you playing?",
+    "What was your most memorable game?",
+    "Who would you like to thank?",
+    "What would you tell someone starting out?",
+    "How has the community changed over the years?",
+]
+
+
+def format_timestamp(seconds):
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(int(minutes), 60)
+    return f"{hours:02d}:{minutes:02d}:{seconds:06.3f}"
+
+
+def create_source(output_file, scenario, idx):
+    duration = scenario["duration"]
+    frame_rate = scenario["frame_rate"]
+    video = f"testsrc2=size={scenario['size']}:rate={frame_rate}:duration={duration}"
+    audio = f"sine=frequency={220 * idx}:sample_rate=48000:duration={duration}"
+    command = (
+        FFMPEG_CMD
+        + ["-f", "lavfi", "-i", video, "-f", "lavfi", "-i", audio]
+        + ["-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p", "-g", str(frame_rate)]
+        + ["-c:a", "aac", "-ac", "2", "-shortest", output_file]
+    )
+    subprocess.check_call(command)
+
+
+def create_image(output_file, source):
+    subprocess.check_call(FFMPEG_CMD + ["-f", "lavfi", "-i", source, "-frames:v", "1", output_file])
+
+
+def create_bgm(output_file, duration):
+    source = f"sine=frequency=330:sample_rate=44100:duration={duration}"
+    subprocess.check_call(FFMPEG_CMD + ["-f", "lavfi", "-i", source, "-ac", "2", output_file])
+
+
+def find_font(pattern):
+    try:
+        return subprocess.check_output(["fc-match", "-f", "%{file}", pattern]).decode("utf8")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def copy_fonts(media_dir, fonts_dir):
+    for name, pattern in FONTS.items():
+        path = os.path.join(fonts_dir, name) if fonts_dir else find_font(pattern)
+        if not path or not os.path.exists(path):
+            raise click.ClickException(f"Could not find {name}, pass a --fonts-dir containing it")
+        shutil.copy(path, os.path.join(media_dir, name))
+
+
+def project_config(scenario, sources):
+    """A config using all the features: crops, replacements, photos, credits and BGM."""
+    rng = random.Random(0)
+    duration = scenario["duration"]
+    clips = []
+    for idx in range(scenario["clips"]):
+        timings = []
+        for sub_idx in range(2):
+            start = rng.uniform(0, duration - 20)
+            end = start + rng.uniform(8, 15)
+            timing = {
+                "video": sources[(idx + sub_idx) % len(sources)],
+                "time": f"{format_timestamp(start)}-{format_timestamp(end)}",
+            }
+            if sub_idx == 1:
+                timing["crop"] = "ih:ih:0:0"
+            timings.append(timing)
+        if idx == 0:
+            timings[0]["replacements"] = [{"time": "1-3", "position": "start"}]
+        clip = {"question": QUESTIONS[idx % len(QUESTIONS)], "timings": timings}
+        if idx % 2:
+            clip["answer"] = "Answered in the clip"
+        clips.append(clip)
+
+    return {
+        "video": sources[0],
+        "crop": "ih:ih:ih/3.2:0",
+        "cover": {"image": "cover.jpg", "time": 3},
+        "credits": {"editing": "Benchmark", "music": "Sine wave"},
+        "photos": [{"photo": "photo.jpg", "time": "00:00:05-00:00:09", "pad": True}],
+        "bgm": {"audio": "bgm.mp3", "fg_volume": 0.4, "bg_volume": 0.1},
+        "audio_threshold": "dynaudnorm=r=1:m=100:g=3:f=100",
+        "clips": clips,
+        "trailer": [
+            {"time": f"{format_timestamp(10)}-{format_timestamp(14)}"},
+            {"video": sources[-1], "time": f"{format_timestamp(30)}-{format_timestamp(33)}"},
+        ],
+    }
+
+
+def generate_project(workdir, name, fonts_dir):
+    """Create the sources, images, music and config of a scenario, unless they exist."""
+    scenario = SCENARIOS[name]
+    media_dir = os.path.join(workdir, "media", name)
+    config_file = os.path.join(workdir, "projects", f"{name}.yml")
+    manifest_file = os.path.join(media_dir, "manifest.json")
+    if os.path.exists(manifest_file):
+        return config_file
+    print(f"Generating the {name} project in {media_dir}")
+    os.makedirs(media_dir, exist_ok=True)
+    os.makedirs(os.path.dirname(config_file), exist_ok=True)
+
+    sources = [f"src-{idx:02d}.mp4" for idx in range(1, scenario["sources"] + 1)]
+    for idx, source in enumerate(sources, start=1):
+        create_source(os.path.join(media_dir, source), scenario, idx)
+    create_image(os.path.join(media_dir, "cover.jpg"), "testsrc2=size=1080x1080")
+    create_image(os.path.join(media_dir, "photo.jpg"), "smptehdbars=size=1280x960")
+    create_bgm(os.path.join(media_dir, "bgm.mp3"), 60)
+    copy_fonts(media_dir, fonts_dir)
+
+    with open(config_file, "w") as f:
+        yaml.dump(project_config(scenario, sources), f)
+    with open(manifest_file, "w") as f:
+        json.dump(sorted(os.listdir(media_dir)) + ["manifest.json"], f)
+    return config_file
+
+
+def clean_project(workdir, name):
+    """Remove everything but the generated inputs, so that each run starts cold."""
+    media_dir = os.path.join(workdir, "media", name)
+    with open(os.path.join(media_dir, "manifest.json")) as f:
+        keep = set(json.load(f))
+    for entry in os.listdir(media_dir):
+        if entry not in keep:
+            path = os.path.join(media_dir, entry)
+            shutil.rmtree(path) if os.path.isdir(path) else os.remove(path)
+
+
+def stage_times(trace_file):
+    """Total wall time of each stage and subprocess in a trace written by --trace."""
+    with open(trace_file) as f:
+        events = json.load(f)["traceEvents"]
+    stages = {}
+    for event in events:
+        if event.get("ph") == "X" and event["cat"] != "target":
+            stages[event["name"]] = stages.get(event["name"], 0) + event["dur"] / 1e6
+    return stages
+
+
+def run_step(workdir, name, step, args, env):
+    media_dir = os.path.join(workdir, "media", name)
+    trace_file = os.path.join(media_dir, f"trace-{step}.json")
+    command = [PROCESS_VIDEO, "--trace", trace_file, f"projects/{name}.yml", step] + args
+    print(f"Running {' '.join(command)}")
+    start = time.perf_counter()
+    subprocess.check_call(command, cwd=workdir, env=env)
+    return time.perf_counter() - start, stage_times(trace_file)
+
+
+def quality_metrics(video, reference, step=30):
+    """SSIM and PSNR of a video against a reference, on every step-th frame."""
+    # Align the first frames, since the muxers may offset the start differently
+    sample = f"setpts=PTS-STARTPTS,framestep={step},split"
+    filters = f"[0:v]{sample}[a0][a1];[1:v]{sample}[b0][b1];[a0][b0]ssim;[a1][b1]psnr"
+    command = ["ffmpeg", "-hide_banner", "-i", video, "-i", reference]
+    command += ["-filter_complex", filters, "-f", "null", "-"]
+    output = subprocess.run(command, capture_output=True, check=True).stderr.decode("utf8")
+    ssim = re.search(r"SSIM .* All:([\d.]+)", output)
+    psnr = re.search(r"PSNR .* average:([\d.]+|inf)", output)
+    return {
+        "ssim": float(ssim.group(1)) if ssim else None,
+        "psnr": float(psnr.group(1)) if psnr else None,
+    }
+
+
+def check_quality(workdir, name, reference_dir):
+    """Compare the deliverables with the references, saving them as references if missing."""
+    media_dir = os.path.join(workdir, "media", name)
+    metrics = {}
+    for pattern in ["ALL-music-*", "trailer-*"]:
+        for video in glob.glob(os.path.join(media_dir, pattern)):
+            reference = os.path.join(reference_dir, name, os.path.basename(video))
+            if not os.path.exists(reference):
+                os.makedirs(os.path.dirname(reference), exist_ok=True)
+                shutil.copy(video, reference)
+                print(f"Saved {reference} as a reference")
+                continue
+            metrics[os.path.basename(video)] = quality_metrics(video, reference)
+    return metrics
+
+
+def git_commit():
+    try:
+        command = ["git", "-C", HERE, "describe", "--always", "--dirty"]
+        return subprocess.check_output(command).decode("utf8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def ffmpeg_version():
+    return subprocess.check_output(["ffmpeg", "-version"]).decode("utf8").splitlines()[0]
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option("--workdir", default="benchmark", type=click.Path(file_okay=False))
+@click.option("--scenario", "scenarios", multiple=True, type=click.Choice(list(SCENARIOS)))
+@click.option("--fonts-dir", type=click.Path(file_okay=False), help="Directory with the fonts")
+def generate(workdir, scenarios, fonts_dir):
+    """Generate the synthetic projects, without running them."""
+    for name in scenarios or SCENARIOS:
+        generate_project(os.path.abspath(workdir), name, fonts_dir)
+
+
+@cli.command()
+@click.option("--workdir", default="benchmark", type=click.Path(file_okay=False))
+@click.option("--scenario", "scenarios", multiple=True, type=click.Choice(list(SCENARIOS)))
+@click.option("--fonts-dir", type=click.Path(file_okay=False), help="Directory with the fonts")
+@click.option("--repeat", default=1, help="Number of times to run each scenario")
+@click.option("--warm/--cold", default=False, help="Keep the segment and probe caches between runs")
+@click.option("--engine", type=click.Choice(["segments", "graph"]), default="segments")
+@click.option("--single-pass/--multi-pass", default=False)
+@click.option(
+    "--reference",
+    type=click.Path(file_okay=False),
+    default=None,
+    help="Compare the outputs with the ones in this directory, saving them there if missing",
+)
+@click.option("-o", "--output", default="benchmark.json", help="File to write the results to")
+def run(workdir, scenarios, fonts_dir, repeat, warm, engine, single_pass, reference, output):
+    """Time process-clips, combine-clips and make-trailer on the synthetic projects."""
+    workdir = os.path.abspath(workdir)
+    cache_dir = os.path.join(workdir, "cache")
+    env = dict(os.environ, HUMANS_CACHE_DIR=cache_dir)
+    args = {
+        "process-clips": ["--engine", engine],
+        "combine-clips": ["--single-pass"] if single_pass else [],
+        "make-trailer": [],
+    }
+    results = {
+        "date": datetime.datetime.now().isoformat(),
+        "commit": git_commit(),
+        "ffmpeg": ffmpeg_version(),
+        "cpu_count": os.cpu_count(),
+        "options": {"warm": warm, "engine": engine, "single_pass": single_pass},
+        "scenarios": {},
+    }
+    for name in scenarios or SCENARIOS:
+        generate_project(workdir, name, fonts_dir)
+        runs = []
+        for _ in range(repeat):
+            clean_project(workdir, name)
+            if not warm:
+                shutil.rmtree(cache_dir, ignore_errors=True)
+            steps = {}
+            for step in STEPS:
+                wall, stages = run_step(workdir, name, step, args[step], env)
+                steps[step] = {"wall": wall, "stages": stages}
+            runs.append(steps)
+        results["scenarios"][name] = {"config": SCENARIOS[name], "runs": runs}
+        if reference:
+            results["scenarios"][name]["quality"] = check_quality(workdir, name, reference)
+
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote results to {output}")
+    print_results(results)
+
+
+def median_times(scenario):
+    """Median wall time of each step, and of each stage in each step, across runs."""
+    medians = {}
+    for step in STEPS:
+        walls = [run[step]["wall"] for run in scenario["runs"]]
+        medians[step] = statistics.median(walls)
+        stages = {stage for run in scenario["runs"] for stage in run[step]["stages"]}
+        for stage in stages:
+            times = [run[step]["stages"].get(stage, 0) for run in scenario["runs"]]
+            medians[f"{step}/{stage}"] = statistics.median(times)
+    return medians
+
+
+def print_results(results):
+    print("Scenario\tStep\tWall (s)")
+    for name, scenario in results["scenarios"].items():
+        medians = median_times(scenario)
+        for step in STEPS:
+            print(f"{name}\t{step}\t{medians[step]:.1f}")
+        for video, metrics in scenario.get("quality", {}).items():
+            print(f"{name}\t{video}\tSSIM {metrics['ssim']}\tPSNR {metrics['psnr']}")
+
+
+@cli.command()
+@click.argument("baseline", type=click.File())
+@click.argument("result", type=click.File())
+@click.option("--threshold", default=0.1, help="Slowdown (as a fraction) to report as a regression")
+@click.option("--min-seconds", default=0.5, help="Ignore stages shorter than this")
+@click.option("--min-ssim", default=0.98, help="Report an SSIM below this as a regression")
+def compare(baseline, result, threshold, min_seconds, min_ssim):
+    """Compare two results files, reporting regressions in time and quality."""
+    baseline, result = json.load(baseline), json.load(result)
+    regressions = 0
+    print("Scenario\tStep/Stage\tBaseline (s)\tResult (s)\tChange")
+    for name, scenario in result["scenarios"].items():
+        if name not in baseline["scenarios"]:
+            continue
+        old, new = median_times(baseline["scenarios"][name]), median_times(scenario)
+        for key in sorted(set(old) | set(new)):
+            before, after = old.get(key, 0), new.get(key, 0)
+            if max(before, after) < min_seconds:
+                continue
+            change = (after - before) / before if before else float("inf")
+            flag = ""
+            if change > threshold:
+                regressions += 1
+                flag = " REGRESSION"
+            print(f"{name}\t{key}\t{before:.1f}\t{after:.1f}\t{change:+.0%}{flag}")
+
+        for video, metrics in scenario.get("quality", {}).items():
+            reference = baseline["scenarios"][name].get("quality", {}).get(video, {})
+            flag = ""
+            if metrics["ssim"] is not None and metrics["ssim"] < min_ssim:
+                regressions += 1
+                flag = " REGRESSION"
+            print(f"{name}\t{video}\tSSIM {reference.get('ssim')} -> {metrics['ssim']}{flag}")
+
+    if regressions:
+        raise click.ClickException(f"{regressions} regressions above {threshold:.0%}")
+
+
+if __name__ == "__main__":
+    cli()
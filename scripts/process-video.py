@@ -1,21 +1,38 @@
 #!/usr/bin/env python3
 
+import asyncio
+import contextlib
+import copy
 import cProfile
 from collections import namedtuple
+from fractions import Fraction
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    CancelledError,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
 import functools
 import glob
 import hashlib
-import io
+import heapq
+import json
 import math
 import multiprocessing
 import os
+import re
+import shutil
 import subprocess
+import sys
 import tempfile
 from textwrap import wrap
+import threading
 import time
 
 import click
 import helium as h
+import numpy as np
 from PIL import Image, ImageOps
 from selenium.webdriver import FirefoxProfile, FirefoxOptions
 import yaml
@@ -25,6 +42,24 @@ HERE = os.path.dirname(os.path.abspath(__file__))
 LOGO_FILE = os.path.join(HERE, "..", "logo.png")
 PART_FILENAME_FMT = "part-{idx:02d}-{video_name}"
 FFMPEG_CMD = ["ffmpeg", "-y"]
+CACHE_DIR = os.environ.get("HUMANS_CACHE_DIR", os.path.join(HERE, "..", "media", ".cache"))
+CACHE_SIZE_GB = 20
+SMART_CUT_MIN_COPY = 10
+PROXY_MAX_SIZE = 500
+SPRITE_INTERVAL = 10
+SPRITE_THUMBNAIL_WIDTH = 160
+SPRITE_COLUMNS = 10
+SCREENSHOT_BATCH_SIZE = 16
+PCM_CHUNK_SAMPLES = 1024 * 1024
+ANALYSIS_SAMPLE_RATE = 16000
+ANALYSIS_WINDOW = 0.05
+SPEECH_MARGIN_DB = 12
+SPEECH_MIN_DBFS = -45
+SPEECH_HANGOVER = 0.3
+DEAD_AIR_MIN = 1.0
+TRIM_PADDING = 0.25
+CPU_COUNT = multiprocessing.cpu_count()
+JOB_CONTEXT = threading.local()
 ENDC = "\033[0m"
 BOLDRED = "\x1B[1;31m"
 
@@ -40,6 +75,411 @@ def log_output_file(fn):
     return wrapper
 
 
+def thread_budget(kind, width, height):
+    """Number of threads to give an ffmpeg job of the given kind and frame size.
+
+    Stream copies and audio only jobs are I/O bound and get a single thread.
+    libx264 stops scaling well beyond a thread per ~160 rows of pixels, so
+    larger frames get more threads. Slides are mostly static, and cheap to
+    encode.
+
+    """
+    if kind in {"copy", "audio"}:
+        return 1
+    threads = max(1, height // 160)
+    if kind == "slide":
+        threads = max(1, threads // 2)
+    return min(threads, CPU_COUNT)
+
+
+def with_threads(command, threads):
+    """Limit the decoders, filters and encoder of an ffmpeg command to threads.
+
+    Commands with several outputs limit each of their encoders with
+    output_threads, and only the single output of other commands is limited.
+
+    """
+    n = str(threads)
+    limited = command[:1] + ["-filter_threads", n, "-filter_complex_threads", n]
+    for arg in command[1:-1]:
+        if arg == "-i":
+            limited += ["-threads", n]
+        limited.append(arg)
+    last_input = max((idx for idx, arg in enumerate(command) if arg == "-i"), default=0)
+    if "-threads" in command[last_input:]:
+        return limited + command[-1:]
+    return limited + ["-threads", n, command[-1]]
+
+
+def output_threads(encoders=1):
+    """Args to share the threads of the current job between the encoders of its outputs."""
+    threads = getattr(JOB_CONTEXT, "threads", None)
+    if not threads:
+        return []
+    return ["-threads", str(max(1, threads // encoders))]
+
+
+TRACE = {"events": None, "threads": {}}
+
+
+def start_tracing():
+    TRACE.update(events=[], threads={}, start=time.perf_counter(), pid=os.getpid())
+
+
+def trace_event(name, category, start, end, tid=None, **args):
+    """Record a complete event, in the Chrome trace event format."""
+    if TRACE["events"] is None:
+        return
+    if tid is None:
+        tid = threading.get_ident()
+        TRACE["threads"].setdefault(tid, threading.current_thread().name)
+    TRACE["events"].append(
+        {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": (start - TRACE["start"]) * 1e6,
+            "dur": (end - start) * 1e6,
+            "pid": os.getpid(),
+            "tid": tid,
+            "args": args,
+        }
+    )
+
+
+@contextlib.contextmanager
+def trace_span(name, category="stage"):
+    """Trace the wall and CPU time of the code run in the block, by this thread."""
+    stages = JOB_CONTEXT.__dict__.setdefault("stages", [])
+    stages.append(name)
+    start, cpu = time.perf_counter(), time.thread_time()
+    try:
+        yield
+    finally:
+        stages.pop()
+        trace_event(name, category, start, time.perf_counter(), cpu=time.thread_time() - cpu)
+
+
+def traced(fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with trace_span(fn.__name__):
+            return fn(*args, **kwargs)
+
+    return wrapper
+
+
+def process_usage(pid):
+    """CPU time, peak RSS and I/O of a running process, read from /proc."""
+    usage = {}
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rpartition(")")[2].split()
+        ticks = os.sysconf("SC_CLK_TCK")
+        usage["cpu"] = sum(int(value) for value in fields[11:15]) / ticks
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    usage["peak_rss_mb"] = int(line.split()[1]) / 1024
+        with open(f"/proc/{pid}/io") as f:
+            for line in f:
+                key, value = line.split(":")
+                if key in {"read_bytes", "write_bytes"}:
+                    usage[key] = int(value)
+    except (OSError, ValueError, IndexError):
+        pass
+    return usage
+
+
+async def sample_usage(pid, usage):
+    """Sample the usage of a process until it exits, since it's reaped by asyncio."""
+    while True:
+        usage.update(process_usage(pid))
+        await asyncio.sleep(0.1)
+
+
+def trace_span_info(command):
+    """Name and thread for the trace event of a command, run by the current stage."""
+    stages = getattr(JOB_CONTEXT, "stages", None)
+    stage = stages[-1] if stages else os.path.basename(command[-1])
+    if TRACE["events"] is not None:
+        TRACE["threads"].setdefault(threading.get_ident(), threading.current_thread().name)
+    return f"{os.path.basename(command[0])} {stage}", threading.get_ident()
+
+
+def file_sizes(paths):
+    return sum(os.path.getsize(path) for path in paths if os.path.isfile(path))
+
+
+def thread_names():
+    return [
+        {"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}}
+        for tid, name in TRACE["threads"].items()
+    ]
+
+
+def drain_trace():
+    """The events traced by a worker process since the last call, with the names of its threads.
+
+    Workers have their own copy of the trace, so the process that started
+    tracing gathers their events to write them.
+
+    """
+    if TRACE["events"] is None or TRACE["pid"] == os.getpid():
+        return []
+    events = thread_names() + TRACE["events"]
+    TRACE.update(events=[], threads={})
+    return events
+
+
+def write_trace(trace_file):
+    """Write the trace as a Chrome trace JSON file, and print a summary of it."""
+    with open(trace_file, "w") as f:
+        json.dump({"traceEvents": thread_names() + TRACE["events"], "displayTimeUnit": "ms"}, f)
+    print(f"Wrote trace to {trace_file}")
+    print_trace_summary(TRACE["events"])
+
+
+def print_trace_summary(events):
+    rows = {}
+    for event in events:
+        if event["ph"] != "X" or event["cat"] == "target":
+            continue
+        args = event["args"]
+        # Calls are grouped by the video encoders they use, to compare codecs
+        name = event["name"]
+        if args.get("video_codecs"):
+            name = f"{name} ({args['video_codecs']})"
+        row = rows.setdefault(name, [0, 0, 0, 0, 0, 0])
+        row[0] += 1
+        row[1] += event["dur"] / 1e6
+        row[2] += args.get("cpu", 0)
+        row[3] = max(row[3], args.get("peak_rss_mb", 0))
+        row[4] += args.get("input_bytes", 0) / 2**20
+        row[5] += args.get("output_bytes", 0) / 2**20
+    print("Stage\tCalls\tWall (s)\tCPU (s)\tPeak RSS (MB)\tInput (MB)\tOutput (MB)")
+    for name, row in sorted(rows.items(), key=lambda item: -item[1][1]):
+        calls, wall, cpu, rss, input_mb, output_mb = row
+        print(f"{name}\t{calls}\t{wall:.1f}\t{cpu:.1f}\t{rss:.0f}\t{input_mb:.1f}\t{output_mb:.1f}")
+
+
+VIDEO_EXTENSIONS = {".mp4", ".mov", ".mkv", ".ts", ".avi", ".webm"}
+RUNNER = {}
+RUNNER_LOCK = threading.Lock()
+JOB_FAILED = threading.Event()
+PROGRESS = {"total": 0, "done": 0, "jobs": {}, "shown": 0}
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def runner_loop():
+    """The event loop, running in a background thread, that all ffmpeg and ffprobe calls share."""
+    with RUNNER_LOCK:
+        if "loop" not in RUNNER:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, daemon=True).start()
+            RUNNER["loop"] = loop
+            RUNNER["tasks"] = set()
+        return RUNNER["loop"]
+
+
+def run_on_runner(coroutine):
+    """Run a coroutine on the shared event loop, and wait for its result."""
+    if JOB_FAILED.is_set():
+        coroutine.close()
+        raise JobCancelled("Cancelled since another job failed")
+    future = asyncio.run_coroutine_threadsafe(coroutine, runner_loop())
+    try:
+        return future.result()
+    except CancelledError:
+        raise JobCancelled("Cancelled since another job failed")
+
+
+def cancel_jobs():
+    """Kill all the running ffmpeg and ffprobe processes, and refuse to start new ones."""
+    JOB_FAILED.set()
+
+    def cancel_tasks():
+        for task in RUNNER["tasks"]:
+            task.cancel()
+
+    # The tasks belong to the loop of the runner, which may run in another thread
+    if "loop" in RUNNER:
+        RUNNER["loop"].call_soon_threadsafe(cancel_tasks)
+
+
+@contextlib.asynccontextmanager
+async def run_process(command, stdout=None, span=None):
+    """Run a command, killing it if the task is cancelled, and returning its process.
+
+    If tracing, the command is recorded with its CPU time, peak RSS and I/O
+    as the event span, a (name, thread) pair.
+
+    """
+    task = asyncio.current_task()
+    RUNNER["tasks"].add(task)
+    start = time.perf_counter()
+    process = await asyncio.create_subprocess_exec(
+        *command, stdin=asyncio.subprocess.DEVNULL, stdout=stdout
+    )
+    usage = {}
+    if TRACE["events"] is not None and span:
+        sampler = asyncio.ensure_future(sample_usage(process.pid, usage))
+    try:
+        yield process
+        await process.wait()
+    except asyncio.CancelledError:
+        process.kill()
+        await process.wait()
+        raise
+    finally:
+        RUNNER["tasks"].discard(task)
+        if TRACE["events"] is not None and span:
+            sampler.cancel()
+            inputs = [command[idx + 1] for idx, arg in enumerate(command) if arg == "-i"]
+            codecs = [command[idx + 1] for idx, arg in enumerate(command) if arg == "-c:v"]
+            outputs = command[-1:]
+            if os.path.basename(command[0]) == "ffprobe":
+                inputs, outputs = command[-1:], []
+            name, tid = span
+            trace_event(
+                name,
+                "subprocess",
+                start,
+                time.perf_counter(),
+                tid,
+                input_bytes=file_sizes(inputs),
+                output_bytes=file_sizes(outputs),
+                video_codecs=",".join(codecs),
+                command=" ".join(command),
+                returncode=process.returncode,
+                **usage,
+            )
+    if process.returncode != 0:
+        cancel_jobs()
+        raise subprocess.CalledProcessError(process.returncode, command)
+
+
+async def ffmpeg_job(name, command, duration, cost, span=None):
+    job = {"name": name, "duration": duration, "cost": cost, "start": time.time()}
+    PROGRESS["jobs"][id(job)] = job
+    try:
+        async with run_process(command, asyncio.subprocess.PIPE, span) as process:
+            async for line in process.stdout:
+                key, _, value = line.decode("utf8").strip().partition("=")
+                job[key] = value
+                if key == "progress":
+                    show_progress()
+    finally:
+        del PROGRESS["jobs"][id(job)]
+    return job
+
+
+async def ffprobe_job(command, span=None):
+    async with run_process(command, asyncio.subprocess.PIPE, span) as process:
+        output = await process.stdout.read()
+    return output
+
+
+def job_fraction(job):
+    """Fraction of a job that is done, based on the timestamp of its output."""
+    try:
+        out_time = int(job.get("out_time_us", 0)) / 1e6
+    except ValueError:
+        out_time = 0
+    if not job["duration"]:
+        return 0
+    return min(max(out_time / job["duration"], 0), 1)
+
+
+def format_eta(seconds):
+    return time.strftime("%M:%S", time.gmtime(seconds)) if seconds < 3600 else ">1h"
+
+
+def show_progress():
+    """Show a progress bar for the whole project, and the progress of each running job."""
+    if not sys.stderr.isatty() or time.time() - PROGRESS["shown"] < 0.5:
+        return
+    PROGRESS["shown"] = time.time()
+    jobs = list(PROGRESS["jobs"].values())
+    running = sum(job["cost"] * job_fraction(job) for job in jobs if job["cost"])
+    total = PROGRESS["total"]
+    fraction = min((PROGRESS["done"] + running) / total, 1) if total else 0
+    bar = "#" * int(fraction * 20)
+    status = [f"[{bar:<20}] {fraction:4.0%}"]
+    for job in jobs:
+        done = job_fraction(job)
+        elapsed = time.time() - job["start"]
+        eta = format_eta(elapsed * (1 - done) / done) if done else "?"
+        status.append(
+            f"{job['name']} {job.get('fps', '?')}fps {job.get('speed', '?').strip()} ETA {eta}"
+        )
+    width = shutil.get_terminal_size().columns - 1
+    print(f"\r{' | '.join(status)}"[:width].ljust(width), end="", file=sys.stderr, flush=True)
+
+
+def clear_progress():
+    if sys.stderr.isatty():
+        print("\r\033[K", end="", file=sys.stderr, flush=True)
+
+
+def report_job(job):
+    elapsed = time.time() - job["start"]
+    metrics = [f"{elapsed:.1f}s"]
+    if float(job.get("fps", 0) or 0) > 0:
+        metrics.append(f"{job['fps']} fps")
+    if job.get("speed", "N/A").strip() != "N/A":
+        metrics.append(job["speed"].strip())
+    clear_progress()
+    print(f"Finished {job['name']} ({', '.join(metrics)})")
+
+
+def expected_duration(command):
+    """Duration of the output of an ffmpeg command, from its -t or its video inputs."""
+    for option in ("-t", "-to"):
+        if option in command:
+            return float(command[command.index(option) + 1])
+    inputs = [command[idx + 1] for idx, arg in enumerate(command) if arg == "-i"]
+    durations = [
+        video_duration(path)
+        for path in inputs
+        if os.path.splitext(path)[-1] in VIDEO_EXTENSIONS and os.path.exists(path)
+    ]
+    return max(durations, default=None)
+
+
+def run_ffmpeg(command, duration=None):
+    """Run an ffmpeg command within the thread budget of the current job, if any.
+
+    The progress of the command is read from ffmpeg's -progress output and
+    shown along with the other running jobs. If the command fails, all the
+    other running commands are killed.
+
+    """
+    threads = getattr(JOB_CONTEXT, "threads", None)
+    if threads:
+        command = with_threads(command, threads)
+    command = command[:1] + ["-nostats", "-progress", "pipe:1"] + command[1:]
+    if duration is None:
+        duration = expected_duration(command)
+    name = getattr(JOB_CONTEXT, "name", None) or os.path.basename(command[-1])
+    cost = getattr(JOB_CONTEXT, "cost", 0)
+    JOB_CONTEXT.encoded = True
+    try:
+        job = run_on_runner(ffmpeg_job(name, command, duration, cost, trace_span_info(command)))
+    except subprocess.CalledProcessError:
+        clear_progress()
+        print(BOLDRED, f"FAILED: {name}: {' '.join(command)}", ENDC, sep="", file=sys.stderr)
+        raise
+    report_job(job)
+
+
+def run_ffprobe(command):
+    return run_on_runner(ffprobe_job(command, trace_span_info(command)))
+
+
 def get_fade_in(time):
     return f"fade=t=in:st={time}:d=0.5"
 
@@ -86,43 +526,142 @@ def compute_drawtext_param(
     return ",".join(format_line(line, i) for i, line in enumerate(lines))
 
 
-def create_black_background(input_file, time=10):
-    w, h = map(int, video_dimensions(input_file))
-    name, ext = os.path.splitext(input_file)
-    background_file = f"black-{name}-{w}x{h}{ext}"
-    if os.path.isfile(background_file):
-        return background_file
+def black_background_inputs(width, height, time, frame_rate, sample_rate=48000, layout="stereo"):
+    if INTERMEDIATE_SPEC:
+        sample_rate = INTERMEDIATE_SPEC["sample_rate"]
+        layout = INTERMEDIATE_SPEC["channel_layout"]
+    return [
+        *("-f", "lavfi", "-t", str(time)),
+        *("-i", f"color=c=black:s={width}x{height}:r={frame_rate}"),
+        *("-f", "lavfi", "-t", str(time)),
+        *("-i", f"anullsrc=r={sample_rate}:cl={layout}"),
+    ]
+
+
+def slide_filter(background, drawtext_param, logo, time, text_fade_out=None):
+    """Filter to draw text and the logo on a background, fading in and out."""
+    FADE_IN = get_fade_in(0)
+    FADE_OUT = get_fade_out(time)
+    TEXT_FADE_OUT = get_fade_out(text_fade_out or time)
+    return (
+        f"{background}{drawtext_param},{FADE_IN},{TEXT_FADE_OUT}[text];"
+        f"[text]{logo}overlay=(main_w-overlay_w):10,{FADE_IN},{FADE_OUT}"
+    )
+
+
+def slide_stream(input_file):
+    """Width, height, frame rate, sample rate and channel layout of a slide for input_file.
+
+    They come from the intermediate spec, if any, which input_file follows,
+    so that the slides are known before the videos they go with are rendered.
+
+    """
+    if INTERMEDIATE_SPEC:
+        spec = INTERMEDIATE_SPEC
+        keys = ["width", "height", "frame_rate", "sample_rate", "channel_layout"]
+        return [spec[key] for key in keys]
+    w, h = video_dimensions(input_file)
+    return [w, h, video_frame_rate(input_file), *audio_parameters(input_file)]
+
+
+def slide_files(input_file, drawtext_param, time, logo_size, text_fade_out=None):
+    """The name of a slide for input_file, and the path of its copy in the cache.
+
+    The slide is cached by its text, fonts, dimensions and timing.
+
+    """
+    w, h, *stream = slide_stream(input_file)
+    ext = os.path.splitext(input_file)[-1]
+    logo_file = image_asset_file(LOGO_FILE, ("logo", logo_size))
+    fonts = sorted(set(re.findall(r"fontfile=([^:]+)", drawtext_param)))
+    key = cache_key(
+        drawtext_param,
+        [file_identity(font) for font in fonts if os.path.exists(font)],
+        [w, h, *stream],
+        INTERMEDIATE_SPEC,
+        RENDER_PROFILE,
+        [time, text_fade_out],
+        os.path.basename(logo_file),
+    )
+    return f"intro-logo-{key}-{w}x{h}{ext}", cache_path("slides", key, ext)
+
+
+@traced
+def create_slide(input_file, drawtext_param, time, logo_size, text_fade_out=None):
+    """Create a slide with the dimensions and stream parameters of input_file.
+
+    The slide is rendered from a synthetic black source in a single encode,
+    unless it is in the cache.
+
+    """
+    output_file, cached_file = slide_files(
+        input_file, drawtext_param, time, logo_size, text_fade_out
+    )
+    if os.path.exists(cached_file):
+        link_cached(cached_file, output_file)
+        return output_file
+
+    w, h, frame_rate, sample_rate, layout = slide_stream(input_file)
+    logo_file = image_asset(LOGO_FILE, ("logo", logo_size))
+    filter_complex = slide_filter("[0:v]", drawtext_param, "[2:v]", time, text_fade_out)
     command = (
         FFMPEG_CMD
-        + ["-i", input_file]
-        + ["-vf", f"trim=0:{time},geq=0:128:128", "-af", f"atrim=0:{time},volume=0"]
-        + [background_file]
+        + black_background_inputs(w, h, time, frame_rate, sample_rate, layout)
+        + ["-i", logo_file]
+        + ["-filter_complex", filter_complex, "-map", "1:a"]
+        + ["-pix_fmt", "yuv420p"]
+        + intermediate_args(output_file)
+        + ["-t", str(time), output_file]
     )
-    subprocess.check_call(command)
-    return background_file
+    run_ffmpeg(command)
+    store_cached(output_file, cached_file)
+    return output_file
+
 
+def cover_filename(w, h, ext):
+    return f"cover-{w}x{h}{ext}"
 
+
+@traced
 def create_cover_video(cover_config, ext):
     w, h = cover_config["width"], cover_config["height"]
-    background_file = glob.glob(f"black-*-{w}x{h}{ext}")[0]
     input_file = cover_config["image"]
-    output_file = f"cover-{w}x{h}{ext}"
+    output_file = cover_filename(w, h, ext)
     time = cover_config["time"]
+    frame_rate = cover_config["frame_rate"]
     FADE_IN = get_fade_in(0)
     FADE_OUT = get_fade_out(time)
     command = (
         FFMPEG_CMD
-        + ["-i", background_file, "-i", input_file]
+        + black_background_inputs(w, h, time, frame_rate)
+        + ["-i", input_file]
         + [
             "-filter_complex",
-            f"[0]trim=0:{time}[bg],[1]scale={w}:{h}[ovrl],[bg][ovrl]overlay=0:0,{FADE_IN},{FADE_OUT}",
+            f"[2]scale={w}:{h}[ovrl],[0][ovrl]overlay=0:0,{FADE_IN},{FADE_OUT}",
         ]
-        + ["-af", f"atrim=0:{time}", "-to", str(time), output_file]
+        + ["-map", "1:a", "-pix_fmt", "yuv420p"]
+        + intermediate_args(output_file)
+        + ["-t", str(time), output_file]
     )
-    subprocess.check_call(command)
+    run_ffmpeg(command)
     return output_file
 
 
+def create_cover(first_part, cover_config):
+    print("Creating cover video...")
+    width, height, frame_rate = slide_stream(first_part)[:3]
+    ext = os.path.splitext(first_part)[-1]
+    cover_config["width"] = width
+    cover_config["height"] = height
+    cover_config["frame_rate"] = frame_rate
+    cover_video = create_cover_video(cover_config, ext)
+    # Create padded cover image
+    print("Creating IGTV cover image...")
+    cover_image = cover_config["image"]
+    link_cached(image_asset(cover_image, ("igtv",)), f"IGTV-{cover_image}")
+    return cover_video
+
+
 def get_credits_text(config):
     entries = []
     n = max(map(len, map(str, config.keys())))
@@ -136,17 +675,13 @@ def get_credits_text(config):
     return "\n".join(entries)
 
 
-def create_credits_video(input_file, credits_config):
-    w, h = map(int, video_dimensions(input_file))
+def credits_slide(input_file, credits_config):
+    """The args of create_slide for the credits, shown after input_file."""
+    w, h = map(int, slide_stream(input_file)[:2])
     time = credits_config.get("time", 2 + len(credits_config) * 2)
     text = get_credits_text(credits_config)
-    ext = os.path.splitext(input_file)[-1]
-    background_file = create_black_background(input_file)
     font_height = int(h / 28)
     logo_size = int(h / 7.5)
-    sha1 = hashlib.sha1(text.encode("utf-8")).hexdigest()
-    FADE_IN = get_fade_in(0)
-    FADE_OUT = get_fade_out(time + 0.3)
     drawtext_param = compute_drawtext_param(
         text,
         fontsize=font_height,
@@ -155,27 +690,15 @@ def create_credits_video(input_file, credits_config):
         h_offset=-2,
         animate=True,
     )
+    return [input_file, drawtext_param, time, logo_size, time + 0.3]
 
-    text_file = f"intro-{sha1}-{w}x{h}{ext}"
-    command = (
-        FFMPEG_CMD
-        + ["-i", background_file]
-        + ["-vf", f"trim=0:{time},{drawtext_param},{FADE_IN},{FADE_OUT}"]
-        + ["-af", f"atrim=0:{time}"]
-        + ["-to", str(time), text_file]
-    )
-    subprocess.check_call(command)
-
-    text_logo_file = f"intro-logo-{sha1}-{w}x{h}{ext}"
-    draw_logo(text_file, text_logo_file, logo_size, time)
 
-    return text_logo_file
+def create_credits_video(input_file, credits_config):
+    return create_slide(*credits_slide(input_file, credits_config))
 
 
-def draw_text(input_file, output_file, text, font_height, time):
+def compute_question_param(text, font_height):
     drawtext_param = compute_drawtext_param(text.q, fontsize=font_height)
-    FADE_IN = get_fade_in(0)
-    FADE_OUT = get_fade_out(time)
     if text.a:
         h_offset = drawtext_param.count("drawtext") + 1
         ans_font_height = round(font_height * 1.1)
@@ -186,80 +709,298 @@ def draw_text(input_file, output_file, text, font_height, time):
             h_offset=h_offset,
         )
         drawtext_param += f",{ans}"
-    command = (
-        FFMPEG_CMD
-        + ["-i", input_file]
-        + ["-vf", f"trim=0:{time},{drawtext_param},{FADE_IN},{FADE_OUT}"]
-        + ["-af", f"atrim=0:{time}"]
-        + ["-to", str(time), output_file]
-    )
-    subprocess.check_call(command)
+    return drawtext_param
 
 
-def resize_logo(logo, size):
-    name = os.path.basename(logo)
-    new_path = os.path.join(os.path.dirname(logo), f"{size}x{size}_{name}")
-    if os.path.exists(new_path):
-        return new_path
+IMAGE_DIGESTS = {}
 
-    with open(logo, "rb") as f:
-        img = Image.open(io.BytesIO(f.read()))
-    img = ImageOps.fit(img, (size, size))
-    with open(new_path, "wb") as out:
-        img.save(out, format="png")
-    return new_path
 
+def image_digest(path):
+    """Hash of the contents of an image, memoized by its path, size and modification time."""
+    identity = (os.path.abspath(path), *file_identity(path))
+    if identity not in IMAGE_DIGESTS:
+        with open(path, "rb") as f:
+            IMAGE_DIGESTS[identity] = hashlib.sha1(f.read()).hexdigest()
+    return IMAGE_DIGESTS[identity]
 
-def create_square_image(image):
-    img = Image.open(image)
+
+def image_asset_file(image, variant):
+    """Path of a variant of an image in the cache, keyed by the contents of the image.
+
+    The variants are ("logo", size) for a square logo, ("photo", width, pad)
+    for a photo overlaid on the video, optionally padded to a square first,
+    and ("igtv",) for the IGTV cover.
+
+    """
+    ext = ".png" if variant[0] in {"logo", "photo"} else os.path.splitext(image)[-1]
+    return cache_path("images", cache_key(image_digest(image), variant), ext)
+
+
+def square_image(img):
     if img.height == img.width:
-        return image
+        return img
 
     size = max(img.height, img.width)
-    new_img = Image.new("RGB", (size, size), color=None)
+    new_img = Image.new("RGB", (size, size))
     padding = int(abs(img.height - img.width) / 2)
     position = (0, padding) if img.height < img.width else (padding, 0)
     new_img.paste(img, position)
+    return new_img
+
+
+def igtv_image(img):
+    """Pad an image with black above and below to the 9:21 aspect ratio of IGTV."""
+    new_h = int(img.height * 21 / 9)
+    pad_h = int((new_h - img.height) / 2)
+    new_img = Image.new("RGB", (img.width, new_h))
+    new_img.paste(img, (0, pad_h))
+    return new_img
 
-    name, ext = os.path.splitext(image)
-    output_file = f"{name}-padded{ext}"
-    new_img.save(output_file, format="jpeg")
+
+def render_image_asset(image, variant, output_file):
+    kind, *args = variant
+    img = Image.open(image)
+    if kind == "logo":
+        (size,) = args
+        img = ImageOps.fit(img, (size, size))
+    elif kind == "photo":
+        width, pad = args
+        img = ImageOps.fit(square_image(img) if pad else img, (width, width))
+    elif kind == "igtv":
+        img = igtv_image(img)
+    name, ext = os.path.splitext(output_file)
+    if ext.lower() in {".jpg", ".jpeg"}:
+        img = img.convert("RGB")
+    tmp_file = f"{name}-{tmp_id()}.tmp{ext}"
+    img.save(tmp_file)
+    os.replace(tmp_file, output_file)
     return output_file
 
 
-def draw_logo(
-    input_file,
-    output_file,
-    size=48,
-    time=3,
-    logo_file=LOGO_FILE,
-    location="(main_w-overlay_w):10",
-):
-    FADE_IN = get_fade_in(0)
-    FADE_OUT = get_fade_out(time)
-    logo_file = resize_logo(logo_file, size)
+def image_asset(image, variant):
+    """A variant of an image, rendered into the cache unless it already is there."""
+    output_file = image_asset_file(image, variant)
+    if not os.path.exists(output_file):
+        render_image_asset(image, variant, output_file)
+    os.utime(output_file)
+    return output_file
+
+
+@traced
+def prepare_image_assets(assets):
+    """Render the missing variants of the images in parallel, with a process pool."""
+    files = {(image, variant): image_asset_file(image, variant) for image, variant in assets}
+    missing = {asset: path for asset, path in files.items() if not os.path.exists(path)}
+    if not missing:
+        return
+    print(f"Preparing {len(missing)} images...")
+    with ProcessPoolExecutor(max_workers=CPU_COUNT) as executor:
+        futures = [
+            executor.submit(render_image_asset, image, variant, output_file)
+            for (image, variant), output_file in missing.items()
+        ]
+        for future in futures:
+            future.result()
+
+
+def project_image_assets(config):
+    """All the image variants needed to render a project with the intermediate spec."""
+    width, height = INTERMEDIATE_SPEC["width"], INTERMEDIATE_SPEC["height"]
+    assets = [(LOGO_FILE, ("logo", int(height / 7.5)))]
+    for photo in config.get("photos", []):
+        assets.append((photo["photo"], ("photo", width, photo.get("pad", False))))
+    if "cover" in config:
+        assets.append((config["cover"]["image"], ("igtv",)))
+    return assets
+
+
+ENCODERS = {"h264": "libx264", "ffv1": "ffv1", "utvideo": "utvideo", "mjpeg": "mjpeg"}
+# Codecs that the intermediate videos can use. The intra-only ones encode
+# faster than x264, especially with the delivery settings, and don't lose
+# quality with each generation, but the files are bigger and need Matroska.
+INTERMEDIATE_CODECS = {
+    "h264": {"video_codec": "h264", "pix_fmt": "yuv420p", "audio_codec": "aac"},
+    "ffv1": {"video_codec": "ffv1", "pix_fmt": "yuv420p", "audio_codec": "pcm_s16le"},
+    "utvideo": {"video_codec": "utvideo", "pix_fmt": "yuv420p", "audio_codec": "pcm_s16le"},
+    "mjpeg": {"video_codec": "mjpeg", "pix_fmt": "yuvj420p", "audio_codec": "pcm_s16le"},
+}
+ENCODER_ARGS = {"ffv1": ["-level", "3", "-g", "1", "-slices", "4"], "mjpeg": ["-q:v", "2"]}
+# The render profiles only tune the lossy codecs of the deliverables
+PROFILE_CODECS = {"h264", "aac"}
+DELIVERY_EXTENSION = ".mp4"
+INTERMEDIATE_SPEC = {}
+RENDER_PROFILES = {
+    "draft": {"preset": "ultrafast", "crf": 32, "audio_bitrate": "96k", "max_frame_rate": 15},
+    "review": {"preset": "veryfast", "crf": 26, "audio_bitrate": "128k"},
+    "delivery": {"preset": "medium", "crf": 20, "audio_bitrate": "192k"},
+}
+RENDER_PROFILE = {}
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png"}
+
+
+def set_render_profile(name):
+    RENDER_PROFILE.clear()
+    RENDER_PROFILE.update(RENDER_PROFILES[name], name=name)
+
+
+def profile_args(output_file, audio=True, video=True, profile=None):
+    """Encoder settings of the render profile (or the given one), for the streams being encoded."""
+    profile = profile or RENDER_PROFILE
+    if not profile or os.path.splitext(output_file)[-1].lower() in IMAGE_EXTENSIONS:
+        return []
+    args = []
+    if video:
+        args += ["-preset", profile["preset"], "-crf", str(profile["crf"])]
+    if audio:
+        args += ["-b:a", profile["audio_bitrate"]]
+    return args
+
+
+def profile_filename(filename):
+    """Tag an output file name with the render profile, unless it's a delivery."""
+    name = RENDER_PROFILE.get("name", "delivery")
+    if name == "delivery":
+        return filename
+    base, ext = os.path.splitext(filename)
+    return f"{base}-{name}{ext}"
+
+
+def part_filename(idx, video_name):
+    filename = profile_filename(PART_FILENAME_FMT.format(idx=idx, video_name=video_name))
+    return intermediate_filename(filename)
+
+
+def intermediate_filename(filename):
+    """Name an intermediate video with the extension of the container its codec needs."""
+    container = INTERMEDIATE_SPEC.get("container")
+    if not container:
+        return filename
+    return f"{os.path.splitext(filename)[0]}{container}"
+
+
+def delivery_filename(filename):
+    """Name of the deliverable rendered from an intermediate video."""
+    if not INTERMEDIATE_SPEC.get("container"):
+        return filename
+    return f"{os.path.splitext(filename)[0]}{DELIVERY_EXTENSION}"
+
+
+def intermediate_spec(config):
+    """The stream parameters that all the parts, intros, cover and credits share.
+
+    Defaults to the size of the first segment after cropping, and the frame
+    rate of its source, capped by the render profile, with H.264 and AAC. Any
+    of the parameters can be overridden using the intermediate key in the
+    config, and choosing another video_codec switches to its audio codec and
+    pixel format, in a Matroska container.
+
+    """
+    params = (config.get("clips") or [{"timings": config["trailer"]}])[0]["timings"][0]
+    info = probe(params["video"])
+    width, height = crop_dimensions(params["crop"], params["video"])
+    frame_rate = info["frame_rate"]
+    max_frame_rate = RENDER_PROFILE.get("max_frame_rate")
+    if max_frame_rate and Fraction(frame_rate) > max_frame_rate:
+        frame_rate = str(max_frame_rate)
+    overrides = config.get("intermediate", {})
+    codec = overrides.get("video_codec", "h264")
+    assert codec in INTERMEDIATE_CODECS, f"Unknown intermediate video codec: {codec}"
+    spec = {
+        "width": width,
+        "height": height,
+        "frame_rate": frame_rate,
+        "time_base": "1/90000",
+        "sample_rate": 48000,
+        "channels": 2,
+        "channel_layout": "stereo",
+    }
+    spec.update(INTERMEDIATE_CODECS[codec])
+    if codec != "h264":
+        spec["container"] = ".mkv"
+    spec.update(overrides)
+    return spec
+
+
+def set_intermediate_spec(config):
+    INTERMEDIATE_SPEC.clear()
+    INTERMEDIATE_SPEC.update(intermediate_spec(config))
+
+
+def intermediate_filters():
+    if not INTERMEDIATE_SPEC:
+        return []
+    return [f"scale={INTERMEDIATE_SPEC['width']}:{INTERMEDIATE_SPEC['height']}", "setsar=1"]
+
+
+def intermediate_args(output_file, audio=True, video=True):
+    if not INTERMEDIATE_SPEC:
+        return []
+    spec = INTERMEDIATE_SPEC
+    args = []
+    if video:
+        args += ["-c:v", ENCODERS[spec["video_codec"]], "-pix_fmt", spec["pix_fmt"]]
+        args += ENCODER_ARGS.get(spec["video_codec"], []) + ["-r", str(spec["frame_rate"])]
+    if os.path.splitext(output_file)[-1].lower() in {".mp4", ".mov"}:
+        args += ["-video_track_timescale", spec["time_base"].split("/")[-1]]
+    if audio:
+        args += ["-c:a", spec["audio_codec"], "-ar", str(spec["sample_rate"])]
+        args += ["-ac", str(spec["channels"])]
+    video = video and spec["video_codec"] in PROFILE_CODECS
+    audio = audio and spec["audio_codec"] in PROFILE_CODECS
+    return args + profile_args(output_file, audio, video)
+
+
+def conforms_to_spec(video):
+    if not INTERMEDIATE_SPEC:
+        return False
+    spec = INTERMEDIATE_SPEC
+    info = probe(video)
+    keys = ["video_codec", "width", "height", "pix_fmt", "audio_codec", "sample_rate", "channels"]
+    if os.path.splitext(video)[-1].lower() in {".mp4", ".mov"}:
+        keys.append("time_base")
+    return all(info[key] == spec[key] for key in keys) and (
+        Fraction(info["frame_rate"]) == Fraction(str(spec["frame_rate"]))
+    )
+
+
+@log_output_file
+@traced
+def encode_delivery(input_file):
+    """Encode a video in an intermediate codec with H.264, using the render profile."""
+    output_file = delivery_filename(input_file)
+    if output_file == input_file:
+        return None
     command = (
         FFMPEG_CMD
-        + ["-i", input_file, "-i", logo_file]
-        + ["-filter_complex", f"overlay={location},{FADE_IN},{FADE_OUT}"]
+        + ["-i", input_file, "-c:v", ENCODERS["h264"], "-pix_fmt", "yuv420p", "-c:a", "aac"]
+        + profile_args(output_file)
         + [output_file]
     )
-    subprocess.check_call(command)
+    run_ffmpeg(command, video_duration(input_file))
+    return output_file
+
+
+def container_filename(filename):
+    """The name of a video concatenated into a container, which is Matroska."""
+    return filename if filename.endswith(".mkv") else f"{filename}.mkv"
 
 
 @log_output_file
+@traced
 def concat_videos(output_file, inputs, use_container=False):
-    # FIXME: Should we use this option everywhere?
     if use_container:
+        output_file = container_filename(output_file)
+    duration = sum(video_duration(video) for video in inputs)
+    # Inputs that conform to the intermediate spec can be stream copied
+    if use_container and not all(conforms_to_spec(video) for video in inputs):
+        print("Inputs don't match the intermediate spec, re-encoding them to concatenate")
         n = len(inputs)
         f_i = "".join(f"[{i}:v:0][{i}:a:0]" for i in range(n))
         f_o = f"concat=n={n}:v=1:a=1[outv][outa]"
         f_args = [arg for f in inputs for arg in ("-i", f)]
         args = f_args + ["-filter_complex", f"{f_i}{f_o}", "-map", "[outv]", "-map", "[outa]"]
-        if not output_file.endswith(".mkv"):
-            output_file = f"{output_file}.mkv"
-        concat_command = FFMPEG_CMD + args + [output_file]
-        subprocess.check_call(concat_command)
+        concat_command = FFMPEG_CMD + args + intermediate_args(output_file) + [output_file]
+        run_ffmpeg(concat_command, duration)
     else:
         with tempfile.NamedTemporaryFile("w", delete=False) as f:
             for input_file in inputs:
@@ -268,29 +1009,153 @@ def concat_videos(output_file, inputs, use_container=False):
         concat_command = (
             FFMPEG_CMD + ["-f", "concat", "-safe", "0", "-i", f.name, "-c", "copy"] + [output_file]
         )
-        subprocess.check_call(concat_command)
+        run_ffmpeg(concat_command, duration)
     return output_file
 
 
-def video_dimensions(video):
+def summarize_probe(data):
+    streams = data.get("streams", [])
+    video = next((s for s in streams if s["codec_type"] == "video"), {})
+    audio = next((s for s in streams if s["codec_type"] == "audio"), {})
+    duration = video.get("duration", data.get("format", {}).get("duration"))
+    keyframes = [
+        float(packet["pts_time"])
+        for packet in data.get("packets", [])
+        if packet.get("stream_index") == video.get("index")
+        and "K" in packet.get("flags", "")
+        and packet.get("pts_time", "N/A") != "N/A"
+    ]
+    intervals = [b - a for a, b in zip(keyframes[:-1], keyframes[1:])]
+    return {
+        "width": video.get("width"),
+        "height": video.get("height"),
+        "duration": float(duration) if duration not in {None, "N/A"} else None,
+        "video_codec": video.get("codec_name"),
+        "pix_fmt": video.get("pix_fmt"),
+        "frame_rate": video.get("r_frame_rate"),
+        "time_base": video.get("time_base"),
+        "keyframe_interval": round(sum(intervals) / len(intervals), 3) if intervals else None,
+        "audio_codec": audio.get("codec_name"),
+        "sample_rate": int(audio["sample_rate"]) if "sample_rate" in audio else None,
+        "channels": audio.get("channels"),
+        "channel_layout": audio.get("channel_layout"),
+    }
+
+
+PROBES = {}
+
+
+def probe(video):
+    """Probe the stream metadata of a video, with a single ffprobe call.
+
+    Results are cached in memory and on disk, keyed by the path, size and
+    modification time of the video.
+
+    """
+    key = cache_key(os.path.abspath(video), file_identity(video))
+    if key in PROBES:
+        return PROBES[key]
+
+    cached_file = cache_path("probes", key, ".json")
+    if os.path.exists(cached_file):
+        with open(cached_file) as f:
+            PROBES[key] = json.load(f)
+        return PROBES[key]
+
     cmd = (
-        ["ffprobe", "-v", "error"]
-        + ["-select_streams", "v:0", "-show_entries", "stream=width,height"]
-        + ["-of", "csv=p=0", video]
+        ["ffprobe", "-v", "error", "-read_intervals", "%+30"]
+        + ["-show_entries", "stream:format=duration:packet=stream_index,pts_time,flags"]
+        + ["-of", "json", video]
     )
-    output = subprocess.check_output(cmd)
-    width, height = [int(x) for x in output.decode("utf8").strip().split(",")]
-    return width, height
+    output = run_ffprobe(cmd)
+    info = summarize_probe(json.loads(output.decode("utf8")))
+    save_json(cached_file, info)
+    PROBES[key] = info
+    return info
 
 
-def video_duration(video):
+def keyframe_index(video):
+    """Timestamps of all the keyframes in a video, cached like the probes."""
+    key = cache_key(os.path.abspath(video), file_identity(video))
+    cached_file = cache_path("keyframes", key, ".json")
+    if os.path.exists(cached_file):
+        with open(cached_file) as f:
+            return json.load(f)
+
     cmd = (
-        ["ffprobe", "-v", "error"]
-        + ["-select_streams", "v:0", "-show_entries", "stream=duration"]
-        + ["-of", "csv=p=0", video]
+        ["ffprobe", "-v", "error", "-select_streams", "v:0"]
+        + ["-show_entries", "packet=pts_time,flags", "-of", "csv=p=0", video]
     )
-    output = subprocess.check_output(cmd)
-    return float(output.decode("utf8").strip())
+    output = run_ffprobe(cmd).decode("utf8")
+    keyframes = sorted(
+        float(pts)
+        for pts, flags, *_ in (line.split(",") for line in output.splitlines() if "," in line)
+        if "K" in flags and pts != "N/A"
+    )
+    save_json(cached_file, keyframes)
+    return keyframes
+
+
+def tmp_id():
+    """Part of the names of temporary files, unique to the process and the thread."""
+    return f"{os.getpid()}-{threading.get_ident()}"
+
+
+def save_json(path, data):
+    tmp_file = f"{path}-{tmp_id()}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_file, path)
+
+
+def probe_many(videos, max_workers=8):
+    videos = sorted(set(videos))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(videos, executor.map(probe, videos)))
+
+
+def video_dimensions(video):
+    info = probe(video)
+    return info["width"], info["height"]
+
+
+def video_frame_rate(video):
+    return probe(video)["frame_rate"]
+
+
+def crop_dimensions(crop, video):
+    """Width and height of a video after cropping it with an expression like ih:ih:ih/3.2:0"""
+    info = probe(video)
+    if not crop:
+        return info["width"], info["height"]
+    return evaluate_crop(crop, info["width"], info["height"], info["pix_fmt"] or "yuv420p")
+
+
+@functools.lru_cache(maxsize=None)
+def evaluate_crop(crop, width, height, pix_fmt):
+    """Size of the output of ffmpeg's crop filter, for a frame of the given size and format.
+
+    The crop filter evaluates the expression on a synthetic frame, so that
+    any expression that ffmpeg supports works, and is rounded the same way.
+
+    """
+    source = f"color=s={width}x{height}:d=0.1,format={pix_fmt},crop={crop}"
+    command = ["ffprobe", "-v", "error", "-show_entries", "stream=width,height", "-of", "json"]
+    try:
+        output = run_ffprobe(command + ["-f", "lavfi", "-i", source])
+    except subprocess.CalledProcessError as error:
+        raise RuntimeError(f"Invalid crop expression {crop}, see the error above") from error
+    stream = json.loads(output.decode("utf8"))["streams"][0]
+    return stream["width"], stream["height"]
+
+
+def audio_parameters(video):
+    info = probe(video)
+    return info["sample_rate"], info["channel_layout"] or "stereo"
+
+
+def video_duration(video):
+    return probe(video)["duration"]
 
 
 def get_time(text):
@@ -299,146 +1164,434 @@ def get_time(text):
     return min(max(4, round(word_count / 2.5)), 8)
 
 
+def question_slide(input_file, q_a):
+    """The args of create_slide for the slide of a question, shown before input_file."""
+    w, h = map(int, slide_stream(input_file)[:2])
+    time = get_time(f"{q_a.q} {q_a.a}")
+    font_height = int(h / 20)
+    logo_size = int(h / 7.5)
+    drawtext_param = compute_question_param(q_a, font_height)
+    return [input_file, drawtext_param, time, logo_size]
+
+
 def prepare_question_video(input_file, q_a):
-    w, h = map(int, video_dimensions(input_file))
     text = f"{q_a.q} {q_a.a}"
     time = get_time(text)
     duration = video_duration(input_file)
     assert duration >= time, f"Too short segment for question slide: {input_file}, {text}"
-    ext = os.path.splitext(input_file)[-1]
-    background_file = create_black_background(input_file)
-    font_height = int(h / 20)
-    logo_size = int(h / 7.5)
-    sha1 = hashlib.sha1(text.encode("utf-8")).hexdigest()
-    text_file = f"intro-{sha1}-{w}x{h}{ext}"
-    text_logo_file = f"intro-logo-{sha1}-{w}x{h}{ext}"
-    draw_text(background_file, text_file, q_a, font_height, time)
-    draw_logo(text_file, text_logo_file, logo_size, time)
-    return text_logo_file
+    return create_slide(*question_slide(input_file, q_a))
 
 
-def split_video(input_file, output_file, start, end, crop, audio_filters=None):
-    start_seconds = to_seconds(start)
-    end_seconds = to_seconds(end)
-    duration = end_seconds - start_seconds
+@traced
+def smart_split_video(input_file, output_file, start, end):
+    """Cut a video re-encoding only the partial GOPs at its start and end.
+
+    The keyframe aligned middle of the cut is stream copied. This is only
+    possible when the video stream of the input already matches the
+    intermediate spec, and returns False when the cut can't be done this way.
+
+    """
+    info = probe(input_file)
+    spec = INTERMEDIATE_SPEC
+    keys = ["video_codec", "width", "height", "pix_fmt"]
+    if not spec or any(info[key] != spec[key] for key in keys):
+        return False
+    if Fraction(info["frame_rate"]) != Fraction(str(spec["frame_rate"])):
+        return False
+    keyframes = [k for k in keyframe_index(input_file) if start <= k <= end]
+    if len(keyframes) < 2 or keyframes[-1] - keyframes[0] < SMART_CUT_MIN_COPY:
+        return False
+
+    print(f"Smart cutting {output_file}")
+    first, last = keyframes[0], keyframes[-1]
+    # Seeking a little past the keyframe makes sure the demuxer lands on it,
+    # and not on the keyframe before it.
+    eps = 0.001
+    name = os.path.splitext(output_file)[0]
+    ext = spec.get("container", ".ts")
+    pieces = []
+    if first - start > eps:
+        pieces.append(f"{name}-head{ext}")
+        command = FFMPEG_CMD + ["-ss", str(start), "-i", input_file, "-t", str(first - start)]
+        run_ffmpeg(command + intermediate_args(pieces[-1]) + [pieces[-1]])
+
+    # Stream copy stops on decode order timestamps, so limit the frame count
+    # to avoid copying any frames after the last keyframe.
+    frames = round((last - first) * Fraction(info["frame_rate"]))
+    pieces.append(f"{name}-middle{ext}")
     command = (
         FFMPEG_CMD
-        # NOTE: Moving -ss before -i makes the cut super fast.
-        # Note, -to is now the time in the output file (so duration of the cut)
-        # See https://stackoverflow.com/a/49080616
-        + ["-ss", str(start_seconds), "-i", input_file, "-to", str(duration)]
-        + [output_file]
+        + ["-ss", str(first + eps), "-i", input_file, "-t", str(last - first)]
+        + ["-frames:v", str(frames), "-map", "0:v:0", "-map", "0:a:0", "-c:v", "copy"]
+        + intermediate_args(pieces[-1], video=False)
+        + [pieces[-1]]
     )
-    if crop:
-        command.insert(-1, "-filter:v")
-        command.insert(-1, f"crop={crop}")
+    run_ffmpeg(command)
+
+    if end - last > eps:
+        pieces.append(f"{name}-tail{ext}")
+        command = FFMPEG_CMD + ["-ss", str(last), "-i", input_file, "-t", str(end - last)]
+        run_ffmpeg(command + intermediate_args(pieces[-1]) + [pieces[-1]])
+
+    concat_videos(output_file, pieces)
+    for piece in pieces:
+        os.remove(piece)
+    return True
+
+
+@traced
+def split_video(
+    input_file,
+    output_file,
+    start,
+    end,
+    crop,
+    audio_filters=None,
+    smart_cut=False,
+    replacements=(),
+    images=(),
+):
+    """Cut a segment of a video, cropping it and patching its replacements in the same encode."""
+    start_seconds = to_seconds(start)
+    end_seconds = to_seconds(end)
+    duration = end_seconds - start_seconds
+    if smart_cut and not crop and not audio_filters and not replacements:
+        if smart_split_video(input_file, output_file, start_seconds, end_seconds):
+            return
+    # NOTE: Moving -ss before -i makes the cut super fast.
+    # See https://stackoverflow.com/a/49080616
+    inputs = ["-ss", str(start_seconds), "-i", input_file]
+    video_filters = ([f"crop={crop}"] if crop else []) + intermediate_filters()
+    if replacements:
+        if INTERMEDIATE_SPEC:
+            size = INTERMEDIATE_SPEC["width"], INTERMEDIATE_SPEC["height"]
+        else:
+            size = crop_dimensions(crop, input_file)
+        filters = [f"[0:v]{','.join(video_filters or ['null'])}[v]"]
+        label = replacements_graph(replacements, images, size, "v", inputs, filters)
+        video_args = ["-filter_complex", ";".join(filters), "-map", f"[{label}]", "-map", "0:a:0"]
+    elif video_filters:
+        video_args = ["-filter:v", ",".join(video_filters)]
+    else:
+        video_args = []
+    # Note, -to is now the time in the output file (so duration of the cut)
+    command = FFMPEG_CMD + inputs + ["-to", str(duration)] + video_args
     if audio_filters:
-        command.insert(-1, "-af")
-        command.insert(-1, audio_filters)
-    subprocess.check_call(command)
+        command += ["-af", audio_filters]
+    command += intermediate_args(output_file) + [output_file]
+    run_ffmpeg(command)
 
 
-def create_video_segments(timings, idx, replacements):
-    segments = []
-    for sub_idx, params in enumerate(timings):
-        video_name = params["video"]
-        timing = params["time"]
-        crop = params["crop"]
-        audio_filters = params.get("audio_filters")
-        start, end = timing.strip().split("-")
-        segment_file = f"segment-{idx:02d}-{sub_idx:02d}-{video_name}"
-        split_video(video_name, segment_file, start, end, crop, audio_filters)
-        replacements = params.get("replacements", [])
-        if replacements:
-            segment_file = do_all_replacements(segment_file, replacements)
-        segments.append(segment_file)
-    return segments
-
-
-def do_all_replacements(input_file, replacements):
-    for replacement in replacements:
-        time = replacement["time"]
-        replace_img = replacement.get("image", replacement.get("position", "start"))
-        start, end = [to_seconds(x) for x in time.strip().split("-")]
-        if replace_img in {"start", "end"}:
-            position = start if replace_img == "start" else end
-            replace_img = capture_screenshot(input_file, start, end, position)
-        output_file = f"replaced-{start}-{end}-{input_file}"
-        replace = (
-            FFMPEG_CMD
-            + ["-i", input_file, "-i", replace_img]
-            + [
-                "-filter_complex",
-                f"[1][0]scale2ref[i][v];[v][i]overlay=x='if(gte(t,{start})*lte(t,{end}),0,NAN)'",
-            ]
-            + ["-c:a", "copy", output_file]
+def replacements_graph(replacements, images, size, label, inputs, filters):
+    """Add the inputs and filters to patch the images over a video, each during its replacement.
+
+    Returns the label of the patched video.
+
+    """
+    base = label
+    for replacement, replace_img in zip(replacements, images):
+        r_start, r_end = [to_seconds(x) for x in replacement["time"].strip().split("-")]
+        m = inputs.count("-i")
+        inputs += ["-i", replace_img]
+        filters.append(f"[{m}:v]scale={size[0]}:{size[1]}[i{m}]")
+        filters.append(
+            f"[{label}][i{m}]overlay=enable='between(t,{r_start},{r_end})'[{base}_{m}]"
         )
-        subprocess.check_call(replace)
-        input_file = output_file
-    return output_file
+        label = f"{base}_{m}"
+    return label
 
 
-def create_overlay_video(input_file, photo, size):
-    time = photo["time"]
-    start, end = [to_seconds(x) for x in time.strip().split("-")]
-    duration = end - start
-    image = photo["photo"]
-    print(f"Creating overlay video for {image}")
-    ext = os.path.splitext(input_file)[-1]
-    overlay_video = f"overlay-{os.path.basename(image)}{ext}"
-    if photo.get("pad", False):
-        image = create_square_image(image)
-    image = resize_logo(image, size)
-    FADE_IN = get_fade_in(0)
-    FADE_OUT = get_fade_out(duration)
-    command = (
-        FFMPEG_CMD
-        + ["-i", input_file, "-i", image]
-        + ["-filter_complex", f"overlay=0,{FADE_IN},{FADE_OUT}"]
-        + ["-t", str(duration), "-an", overlay_video]
+def file_identity(path):
+    stat = os.stat(path)
+    return [os.path.basename(path), stat.st_size, stat.st_mtime_ns]
+
+
+def cache_key(*parts):
+    data = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+def cache_path(kind, key, ext):
+    directory = os.path.join(CACHE_DIR, kind)
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, f"{key}{ext}")
+
+
+def link_cached(cached_file, output_file):
+    # Touching the cached file on every hit is what makes eviction LRU
+    os.utime(cached_file)
+    if os.path.lexists(output_file):
+        os.remove(output_file)
+    try:
+        os.link(cached_file, output_file)
+    except OSError:
+        shutil.copyfile(cached_file, output_file)
+
+
+def store_cached(output_file, cached_file):
+    name, ext = os.path.splitext(cached_file)
+    tmp_file = f"{name}-{tmp_id()}.tmp{ext}"
+    try:
+        os.link(output_file, tmp_file)
+    except OSError:
+        shutil.copyfile(output_file, tmp_file)
+    os.replace(tmp_file, cached_file)
+
+
+def evict_cache(size_gb=CACHE_SIZE_GB):
+    """Remove least recently used cache entries until the cache fits the budget."""
+    if not os.path.isdir(CACHE_DIR):
+        return
+    entries = [
+        entry
+        for directory in os.scandir(CACHE_DIR)
+        if directory.is_dir()
+        for entry in os.scandir(directory.path)
+        if entry.is_file()
+    ]
+    entries = sorted(entries, key=lambda entry: entry.stat().st_mtime)
+    total = sum(entry.stat().st_size for entry in entries)
+    budget = size_gb * 1024 ** 3
+    for entry in entries:
+        if total <= budget:
+            break
+        total -= entry.stat().st_size
+        os.remove(entry.path)
+
+
+def segment_cache_key(params):
+    replacements = params.get("replacements", [])
+    images = [
+        file_identity(replacement["image"])
+        for replacement in replacements
+        if "image" in replacement
+    ]
+    return cache_key(
+        file_identity(params["video"]),
+        INTERMEDIATE_SPEC,
+        RENDER_PROFILE,
+        params["time"].strip(),
+        params["crop"],
+        params.get("audio_filters"),
+        params.get("smart_cut", False),
+        replacements,
+        images,
     )
-    subprocess.check_call(command)
-    photo["video"] = overlay_video
-    photo["start"] = start
-    photo["end"] = end
+
+
+def segment_cached(params):
+    ext = os.path.splitext(intermediate_filename(params["video"]))[-1]
+    return os.path.exists(cache_path("segments", segment_cache_key(params), ext))
+
+
+def segment_filename(idx, sub_idx, video_name):
+    return intermediate_filename(f"segment-{idx:02d}-{sub_idx:02d}-{video_name}")
+
+
+def create_video_segment(params, idx, sub_idx):
+    video_name = params["video"]
+    timing = params["time"]
+    crop = params["crop"]
+    audio_filters = params.get("audio_filters")
+    start, end = timing.strip().split("-")
+    segment_file = segment_filename(idx, sub_idx, video_name)
+    ext = os.path.splitext(segment_file)[-1]
+    cached_file = cache_path("segments", segment_cache_key(params), ext)
+    if os.path.exists(cached_file):
+        link_cached(cached_file, segment_file)
+        return segment_file
+
+    # The segment may be a hard link to another cache entry, from an earlier
+    # hit, which writing to it in place would overwrite
+    if os.path.lexists(segment_file):
+        os.remove(segment_file)
+    smart_cut = params.get("smart_cut", False)
+    replacements = params.get("replacements", [])
+    images = replacement_images(params)
+    split_video(
+        video_name, segment_file, start, end, crop, audio_filters, smart_cut, replacements, images
+    )
+    store_cached(segment_file, cached_file)
+    return segment_file
+
+
+def create_video_segments(timings, idx):
+    return [
+        create_video_segment(params, idx, sub_idx) for sub_idx, params in enumerate(timings)
+    ]
+
+
+def photos_filename(input_file):
+    return f"photos-{input_file}"
 
 
 @log_output_file
+@traced
 def overlay_photos(input_file, photos):
-    # Create scaled images
-    w, _ = video_dimensions(input_file)
-    for photo in photos:
-        create_overlay_video(input_file, photo, w)
+    """Overlay the photos on a video, with a single encode.
+
+    The resized photos are looped image inputs, each faded and shown only
+    during its time, so no intermediate videos are needed for the photos.
 
-    # Overlay videos
+    """
+    w, _ = video_dimensions(input_file)
+    frame_rate = video_frame_rate(input_file)
     n = len(photos)
     print(f"Overlaying {n} photos on video")
-    output_file = f"photos-{input_file}"
-    overlay_filter = [
-        f"[{idx}]setpts=PTS-STARTPTS+{P['start']}/TB[v{idx}];"
-        f"[out{idx-1}][v{idx}]overlay=enable='between(t,{P['start']},{P['end']})'[out{idx}]"
-        for idx, P in enumerate(photos, start=1)
-    ]
-    filter_complex = ";".join(overlay_filter).replace("out0", "0").replace(f"[out{n}]", "")
+    output_file = photos_filename(input_file)
+    inputs, filters = ["-i", input_file], []
+    video = photos_graph(photos, w, frame_rate, inputs, filters, "0:v")
     command = (
         FFMPEG_CMD
-        + ["-i", input_file]
-        + [arg for photo in photos for arg in ["-i", photo["video"]]]
-        + ["-filter_complex", filter_complex, output_file]
+        + inputs
+        + ["-filter_complex", ";".join(filters)]
+        + ["-map", f"[{video}]", "-map", "0:a", "-c:a", "copy"]
+        + intermediate_args(output_file, audio=False)
+        + [output_file]
     )
-    subprocess.check_call(command)
+    run_ffmpeg(command, video_duration(input_file))
     return output_file
 
 
-def capture_screenshot(input_file, start, end, position):
-    img = f"{input_file}-{position}.png"
-    select = (
-        FFMPEG_CMD
-        + ["-i", input_file]
-        + ["-vf", f"select=gte(t\\,{position})", "-vframes", "1", img]
+def photos_graph(photos, width, frame_rate, inputs, filters, label):
+    """Add the filters to overlay photos, each fading in and out of black."""
+    for photo in photos:
+        start, end = [to_seconds(x) for x in photo["time"].strip().split("-")]
+        duration = end - start
+        image = image_asset(photo["photo"], ("photo", width, photo.get("pad", False)))
+        n = inputs.count("-i")
+        inputs += ["-loop", "1", "-framerate", frame_rate, "-t", str(duration), "-i", image]
+        FADE_IN = get_fade_in(0)
+        FADE_OUT = get_fade_out(duration)
+        filters.append(f"[{n}:v]{FADE_IN},{FADE_OUT},setpts=PTS-STARTPTS+{start}/TB[p{n}]")
+        filters.append(f"[{label}][p{n}]overlay=enable='between(t,{start},{end})'[o{n}]")
+        label = f"o{n}"
+    return label
+
+
+@log_output_file
+@traced
+def render_final(video_names, output_file, config):
+    """Render the final video with a single encode.
+
+    The cover, parts and credits are concatenated, and the photos, audio
+    threshold and background music are applied in the same filter graph,
+    which also renders the IGTV (and review) copies of the video.
+
+    """
+    n = len(video_names)
+    inputs = [arg for name in video_names for arg in ("-i", name)]
+    streams = "".join(f"[{i}:v:0][{i}:a:0]" for i in range(n))
+    filters = [f"{streams}concat=n={n}:v=1:a=1[v][a]"]
+    video, audio = "v", "a"
+
+    photos = config.get("photos")
+    if photos:
+        width, _ = video_dimensions(video_names[0])
+        frame_rate = video_frame_rate(video_names[0])
+        video = photos_graph(photos, width, frame_rate, inputs, filters, video)
+
+    if "audio_threshold" in config:
+        filters.append(f"[{audio}]{config['audio_threshold']}[thresholded]")
+        audio = "thresholded"
+
+    if "bgm" in config:
+        n = inputs.count("-i")
+        inputs += ["-stream_loop", "-1", "-i", os.path.abspath(config["bgm"]["audio"])]
+        filters.append(f"[{n}:a]{background_music_filter(config)}[bgm]")
+        filters.append(f"[{audio}][bgm]amix=inputs=2[music]")
+        audio = "music"
+
+    size = video_dimensions(video_names[0])
+    outputs = final_outputs(output_file, size, config.get("review_copy", False))
+    args = output_args(outputs, video, audio, filters)
+    command = FFMPEG_CMD + inputs + ["-filter_complex", ";".join(filters)] + args
+    print(f"Rendering {output_file} and its copies in a single pass...")
+    run_ffmpeg(command, sum(video_duration(name) for name in video_names))
+    return output_file
+
+
+def screenshot_positions(params):
+    """Positions in the source video of the stills needed by the replacements of a segment."""
+    start = to_seconds(params["time"].strip().split("-")[0])
+    positions = []
+    for replacement in params.get("replacements", []):
+        image = replacement.get("image", replacement.get("position", "start"))
+        if image in {"start", "end"}:
+            r_start, r_end = [to_seconds(x) for x in replacement["time"].strip().split("-")]
+            positions.append(round(start + (r_start if image == "start" else r_end), 3))
+    return positions
+
+
+def replacement_images(params):
+    """The image to patch over the video for each replacement of a segment."""
+    positions = screenshot_positions(params)
+    stills = iter(capture_screenshots(params["video"], positions, params["crop"]))
+    images = [
+        replacement.get("image", replacement.get("position", "start"))
+        for replacement in params.get("replacements", [])
+    ]
+    return [next(stills) if image in {"start", "end"} else image for image in images]
+
+
+def screenshot_cache_file(video, position, crop):
+    return cache_path("screenshots", cache_key(file_identity(video), position, crop), ".png")
+
+
+@traced
+def capture_screenshots(video, positions, crop):
+    """Capture stills of a video at the given positions, cached by the video, position and crop.
+
+    All the missing stills are captured with a single ffmpeg call, that seeks
+    to each of them in a separate input, so only the frames since the previous
+    keyframe are decoded for every still. If seeking doesn't produce a frame,
+    the still is captured by decoding the video up to it instead.
+
+    """
+    cached_files = [screenshot_cache_file(video, position, crop) for position in positions]
+    missing = sorted(
+        {position for position, path in zip(positions, cached_files) if not os.path.exists(path)}
     )
-    subprocess.check_call(select)
-    return img
+    crop_args = ["-vf", f"crop={crop}"] if crop else []
+    for batch_start in range(0, len(missing), SCREENSHOT_BATCH_SIZE):
+        batch = missing[batch_start : batch_start + SCREENSHOT_BATCH_SIZE]
+        tmp_files = [screenshot_cache_file(video, position, crop) for position in batch]
+        tmp_files = [f"{path[:-len('.png')]}-{tmp_id()}.tmp.png" for path in tmp_files]
+        command = list(FFMPEG_CMD)
+        for position in batch:
+            command += ["-ss", str(position), "-i", video]
+        for n, tmp_file in enumerate(tmp_files):
+            command += ["-map", f"{n}:v:0", "-frames:v", "1"] + crop_args + [tmp_file]
+        run_ffmpeg(command, duration=0)
+        for position, tmp_file in zip(batch, tmp_files):
+            if not os.path.exists(tmp_file) or os.path.getsize(tmp_file) == 0:
+                select = f"select=gte(t\\,{position})" + (f",crop={crop}" if crop else "")
+                command = FFMPEG_CMD + ["-i", video, "-vf", select, "-frames:v", "1", tmp_file]
+                run_ffmpeg(command)
+            assert os.path.exists(tmp_file), f"No frame to capture at {position}s in {video}"
+            os.replace(tmp_file, screenshot_cache_file(video, position, crop))
+    for cached_file in cached_files:
+        os.utime(cached_file)
+    return cached_files
+
+
+def prefetch_screenshots(clips, engine="segments"):
+    """Capture the stills for all the replacements of the clips, with one batch per source."""
+    batches = {}
+    for clip in clips:
+        for params in clip["timings"]:
+            if engine == "segments" and segment_cached(params):
+                continue
+            key = (params["video"], params["crop"])
+            batches.setdefault(key, []).extend(screenshot_positions(params))
+    batches = {key: positions for key, positions in batches.items() if positions}
+    with ThreadPoolExecutor(max_workers=CPU_COUNT) as executor:
+        futures = [
+            executor.submit(capture_screenshots, video, positions, crop)
+            for (video, crop), positions in batches.items()
+        ]
+        for future in futures:
+            future.result()
 
 
 def to_seconds(timestamp):
@@ -468,59 +1621,256 @@ def process_config(config, use_original):
             params["video"] = alt_low_res.get(video, video)
 
             params.setdefault("crop", clip_crop)
+            params.setdefault("smart_cut", config.get("smart_cut", False))
 
     for each in config.get("trailer", []):
         video = each.get("video", config["video"])
         each["video"] = alt_low_res.get(video, video)
         each.setdefault("crop", config["crop"])
+        each.setdefault("smart_cut", config.get("smart_cut", False))
 
 
-def create_low_res(input_file, output_file):
-    width, height = video_dimensions(input_file)
-    size = max(width, height)
-    while size > 500:
-        size /= 2
-        width /= 2
-        height /= 2
+def proxy_size(width, height, max_size=PROXY_MAX_SIZE):
+    """Size of the proxy of a video, scaled down by the smallest power of two that fits max_size."""
+    factor = 2 ** max(0, math.ceil(math.log2(max(width, height) / max_size)))
+    return 2 * round(width / factor / 2), 2 * round(height / factor / 2)
 
+
+def proxy_args(frame_rate):
+    """Encoder settings for proxies, with a short GOP so that they are quick to seek."""
+    gop = max(1, round(Fraction(frame_rate) / 2))
+    video = ["-c:v", "libx264", "-preset", "veryfast", "-tune", "fastdecode", "-crf", "23"]
+    video += ["-g", str(gop), "-pix_fmt", "yuv420p"]
+    return video + ["-c:a", "copy", "-movflags", "+faststart"]
+
+
+@traced
+def create_low_res(input_file, output_file):
+    """Create a proxy of a video, and a sprite sheet of its thumbnails in the same pass."""
+    width, height = proxy_size(*video_dimensions(input_file))
+    sprite = (
+        f"fps=1/{SPRITE_INTERVAL},scale={SPRITE_THUMBNAIL_WIDTH}:-2,"
+        f"tile={SPRITE_COLUMNS}x{SPRITE_COLUMNS}"
+    )
     print(f"Creating low res video for {input_file}...")
-    cmd = FFMPEG_CMD + ["-i", input_file, "-vf", f"scale={width}:{height}", output_file]
-    subprocess.check_call(cmd)
+    cmd = (
+        FFMPEG_CMD
+        + ["-i", input_file]
+        + [
+            "-filter_complex",
+            f"[0:v]scale={width}:{height},split[proxy][thumbs];[thumbs]{sprite}[sprite]",
+        ]
+        + ["-map", "[proxy]", "-map", "0:a?"]
+        + proxy_args(video_frame_rate(input_file))
+        + output_threads()
+        + [output_file]
+        + ["-map", "[sprite]", "-fps_mode", "passthrough", "-threads", "1"]
+        + [f"{output_file}-sprite-%02d.jpg"]
+    )
+    run_ffmpeg(cmd, video_duration(input_file))
 
 
-@log_output_file
-def create_igtv_video(input_file, output_file):
-    w, h = video_dimensions(input_file)
-    new_h = int(h * 21 / 9)
-    pad_h = int((new_h - h) / 2)
-    cmd = FFMPEG_CMD + ["-i", input_file] + ["-vf", f"pad={w}:{new_h}:0:{pad_h}", output_file]
-    subprocess.check_call(cmd)
+def build_proxy(inputs, input_file, output_file):
+    create_low_res(input_file, output_file)
+    # Index the keyframes of the proxy, for seeking into it while editing
+    keyframe_index(output_file)
+    return output_file
+
+
+def proxy_output(inputs, input_file, output_file):
+    return output_file
+
+
+def create_proxies(proxies):
+    """Create the proxies, a map of videos to their proxy file names, in parallel."""
+    probe_many(proxies)
+    nodes = {}
+    for video, output_file in proxies.items():
+        width, height = proxy_size(*video_dimensions(video))
+        params = [file_identity(video), output_file, proxy_args(video_frame_rate(video))]
+        seconds = video_duration(video)
+        cost = seconds * width * height / 1e6
+        threads = thread_budget("encode", width, height)
+        args = [video, output_file]
+        nodes[output_file] = Node(
+            [], params, build_proxy, args, cost, threads, seconds, proxy_output
+        )
+    run_graph(nodes, calibrate=False)
+
+
+def igtv_filter(width, height):
+    """Pad a video with black above and below to the 9:21 aspect ratio of IGTV."""
+    new_h = int(height * 21 / 9)
+    pad_h = int((new_h - height) / 2)
+    return f"pad={width}:{new_h}:0:{pad_h}"
+
+
+def final_outputs(output_file, size, review=False, copy_video=False):
+    """The final video and the copies published along with it.
+
+    Each output is a filename, the filter to make its video from the final
+    video (None to stream copy it) and the render profile to encode it with.
+    The copies are the IGTV video, and optionally a low res copy for review.
+
+    """
+    w, h = size
+    outputs = [
+        (output_file, None if copy_video else "null", RENDER_PROFILE),
+        (f"IGTV-{output_file}", igtv_filter(w, h), RENDER_PROFILE),
+    ]
+    if review:
+        scale = "scale={}:{}".format(*proxy_size(w, h))
+        outputs.append((f"REVIEW-{output_file}", scale, RENDER_PROFILES["review"]))
+    return outputs
+
+
+def output_args(outputs, video, audio, filters):
+    """Add the filters to split the video and audio into all the outputs, and return their args.
+
+    The video and audio are decoded and filtered once, and only encoded
+    separately for each output. video and audio are labels of filters, or
+    input streams like 0:v, which is required to stream copy the video.
+
+    """
+    encoded = [(name, vf) for name, vf, _ in outputs if vf is not None]
+    splits = "".join(f"[split{n}]" for n in range(len(encoded)))
+    filters.append(f"[{video}]split={len(encoded)}{splits}")
+    for n, (_, vf) in enumerate(encoded):
+        filters.append(f"[split{n}]{vf}[video{n}]")
+    asplits = "".join(f"[audio{n}]" for n in range(len(outputs)))
+    filters.append(f"[{audio}]asplit={len(outputs)}{asplits}")
+
+    args = []
+    videos = iter(f"[video{n}]" for n in range(len(encoded)))
+    threads = output_threads(len(encoded) or 1)
+    for n, (name, vf, profile) in enumerate(outputs):
+        if vf is None:
+            args += ["-map", video, "-map", f"[audio{n}]", "-c:v", "copy"]
+            args += ["-c:a", "aac"] + profile_args(name, video=False, profile=profile)
+        else:
+            args += ["-map", next(videos), "-map", f"[audio{n}]"]
+            args += ["-c:v", ENCODERS["h264"], "-pix_fmt", "yuv420p"]
+            args += profile_args(name, profile=profile)
+        args += threads + [name]
+    return args
+
+
+@traced
+def create_copies(input_file, review=False):
+    """Create the IGTV (and review) copies of a final video, from a single decode.
+
+    If the video uses an intermediate codec, the deliverable is encoded from
+    it along with the copies.
+
+    """
+    print("Creating IGTV video...")
+    output_file = delivery_filename(input_file)
+    outputs = final_outputs(output_file, video_dimensions(input_file), review)
+    if output_file == input_file:
+        outputs = outputs[1:]
+    filters = []
+    args = output_args(outputs, "0:v", "0:a", filters)
+    command = FFMPEG_CMD + ["-i", input_file, "-filter_complex", ";".join(filters)] + args
+    run_ffmpeg(command)
+    for name, _, _ in outputs:
+        print(f"Created {os.path.abspath(name)}")
+    return outputs[0][0]
+
+
+def get_question(clip):
+    q = clip.get("question", "")
+    a = clip.get("answer", "")
+    if q:
+        return QnA(q, a)
+    return QnA("...")
+
+
+def intro_graph(q_a, width, height, time, frame_rate, inputs, filters):
+    """Add the filters to render an intro slide from a synthetic black source."""
+    n = inputs.count("-i")
+    font_height = int(height / 20)
+    logo_size = int(height / 7.5)
+    logo_file = image_asset(LOGO_FILE, ("logo", logo_size))
+    drawtext_param = compute_question_param(q_a, font_height)
+    inputs += black_background_inputs(width, height, time, frame_rate)
+    inputs += ["-i", logo_file]
+    slide = slide_filter(f"[{n}:v]", drawtext_param, f"[{n + 2}:v]", time)
+    filters.append(f"{slide},setsar=1[intro_v]")
+    filters.append(f"[{n + 1}:a]anull[intro_a]")
+    return "[intro_v][intro_a]"
+
+
+def segment_graph(params, size, inputs, filters):
+    """Add the input and filters to cut, crop and patch a segment of a video."""
+    n = inputs.count("-i")
+    video = params["video"]
+    start, end = [to_seconds(x) for x in params["time"].strip().split("-")]
+    inputs += ["-ss", str(start), "-t", str(end - start), "-i", video]
+    video_filters = ["setpts=PTS-STARTPTS"]
+    if params["crop"]:
+        video_filters.append(f"crop={params['crop']}")
+    video_filters += [f"scale={size[0]}:{size[1]}", "setsar=1"]
+    filters.append(f"[{n}:v]{','.join(video_filters)}[v{n}]")
+    replacements = params.get("replacements", [])
+    images = replacement_images(params)
+    label = replacements_graph(replacements, images, size, f"v{n}", inputs, filters)
+    audio_filters = params.get("audio_filters") or "anull"
+    filters.append(f"[{n}:a]asetpts=PTS-STARTPTS,{audio_filters}[a{n}]")
+    return f"[{label}][a{n}]"
 
 
 @log_output_file
-def process_clip(clip, with_intro, idx):
-    print(f"Creating part {idx}")
-    replacements = clip.get("replacements")
-    segments = create_video_segments(clip["timings"], idx, replacements)
-    output_file = PART_FILENAME_FMT.format(idx=idx, video_name=clip["timings"][0]["video"])
+@traced
+def process_clip_graph(clip, with_intro, idx):
+    """Render a clip with a single ffmpeg call, decoding and encoding it once.
+
+    Each segment is a separate input seeked to its start, and the segments are
+    cropped, patched with their replacements and concatenated along with the
+    intro slide, in one filter graph.
+
+    """
+    print(f"Creating part {idx} in a single pass")
+    timings = clip["timings"]
+    first_video = timings[0]["video"]
+    output_file = part_filename(idx, first_video)
+    if INTERMEDIATE_SPEC:
+        size = INTERMEDIATE_SPEC["width"], INTERMEDIATE_SPEC["height"]
+    else:
+        size = crop_dimensions(timings[0]["crop"], first_video)
+    inputs, filters, streams = [], [], []
+    duration = get_clip_duration(clip)
 
     if with_intro:
-        q = clip.get("question", "")
-        a = clip.get("answer", "")
-        if q:
-            q_n_a = [q, a]
-            q_n_a = QnA(*q_n_a)
-        else:
-            q_n_a = QnA("...")
-        segment_timings = zip([get_segment_duration(s) for s in clip["timings"]], segments)
-        longest_segment = sorted(segment_timings, reverse=True)[0][-1]
-        intro_file = prepare_question_video(longest_segment, q_n_a)
-        segments.insert(0, intro_file)
-
-    concat_videos(output_file, segments)
+        q_n_a = get_question(clip)
+        time = get_time(f"{q_n_a.q} {q_n_a.a}")
+        longest = max(get_segment_duration(s) for s in timings)
+        assert longest >= time, f"Too short segments for question slide: {q_n_a}"
+        frame_rate = video_frame_rate(first_video)
+        streams.append(intro_graph(q_n_a, *size, time, frame_rate, inputs, filters))
+        duration += time
+
+    for params in timings:
+        streams.append(segment_graph(params, size, inputs, filters))
+
+    n = len(streams)
+    filters.append(f"{''.join(streams)}concat=n={n}:v=1:a=1[outv][outa]")
+    command = (
+        FFMPEG_CMD
+        + inputs
+        + ["-filter_complex", ";".join(filters)]
+        + ["-map", "[outv]", "-map", "[outa]"]
+        + intermediate_args(output_file)
+        + [output_file]
+    )
+    run_ffmpeg(command, duration)
     return output_file
 
 
+def longest_segment_index(timings):
+    durations = [get_segment_duration(segment) for segment in timings]
+    return max(range(len(durations)), key=lambda idx: (durations[idx], idx))
+
+
 def get_segment_duration(segment):
     timing = segment["time"]
     start, end = timing.strip().split("-")
@@ -532,7 +1882,106 @@ def get_clip_duration(clip):
     return sum(durations)
 
 
-def create_background_music_file(config):
+AUDIO_INDEXES = {}
+
+
+def audio_index(video):
+    """Windowed RMS, peaks and speech flags of the audio of a video.
+
+    The audio is decoded once to mono samples, and the index is cached as a
+    compressed npz file like the probes, keyed by the path, size and
+    modification time of the video.
+
+    """
+    speech_params = [SPEECH_MARGIN_DB, SPEECH_MIN_DBFS, SPEECH_HANGOVER]
+    key = cache_key(os.path.abspath(video), file_identity(video), ANALYSIS_WINDOW, speech_params)
+    if key in AUDIO_INDEXES:
+        return AUDIO_INDEXES[key]
+
+    cached_file = cache_path("audio", key, ".npz")
+    if not os.path.exists(cached_file):
+        print(f"Analyzing audio of {video}...")
+        pcm_file = cache_path("audio", f"{key}-{tmp_id()}", ".f32")
+        samples = decode_pcm(video, pcm_file, ANALYSIS_SAMPLE_RATE, channels=1)[:, 0]
+        window = int(ANALYSIS_SAMPLE_RATE * ANALYSIS_WINDOW)
+        windows = samples[: len(samples) // window * window].reshape(-1, window)
+        rms = np.sqrt(np.mean(np.square(windows, dtype=np.float64), axis=1))
+        peak = np.max(np.abs(windows), axis=1)
+        del samples, windows
+        os.remove(pcm_file)
+        tmp_file = cache_path("audio", f"{key}-{tmp_id()}.tmp", ".npz")
+        np.savez_compressed(
+            tmp_file, rms=rms.astype(np.float32), peak=peak, speech=speech_flags(rms)
+        )
+        os.replace(tmp_file, cached_file)
+
+    with np.load(cached_file) as data:
+        index = {name: data[name] for name in ("rms", "peak", "speech")}
+    AUDIO_INDEXES[key] = index
+    return index
+
+
+def speech_flags(rms):
+    """Flag the windows with speech, which are the ones well above the noise floor.
+
+    The threshold is capped below the loud parts, for recordings without any
+    pauses, and the pauses between words shorter than the hangover are not
+    counted as silence. Audio with no quieter parts to compare with, like
+    room tone alone, only counts as speech if it is loud.
+
+    """
+    level = 20 * np.log10(np.maximum(rms, 1e-6))
+    floor, loud = np.percentile(level, [10, 95]) if len(level) else (0, 0)
+    threshold = SPEECH_MIN_DBFS
+    if loud - floor > SPEECH_MARGIN_DB:
+        threshold = max(min(floor + SPEECH_MARGIN_DB, loud - SPEECH_MARGIN_DB), threshold)
+    speech = level > threshold
+    # Close the short gaps, by widening the speech by the hangover and narrowing it back
+    kernel = np.ones(2 * int(SPEECH_HANGOVER / ANALYSIS_WINDOW) + 1)
+    speech = np.convolve(speech, kernel, mode="same") > 0
+    return np.convolve(~speech, kernel, mode="same") == 0
+
+
+def index_range(index, start, end):
+    first = int(start / ANALYSIS_WINDOW)
+    last = min(int(math.ceil(end / ANALYSIS_WINDOW)), len(index["speech"]))
+    return first, max(first, last)
+
+
+def suggest_trim(index, start, end, padding=TRIM_PADDING):
+    """Tightest start and end around the speech between start and end, or None if it is silent."""
+    first, last = index_range(index, start, end)
+    speaking = np.flatnonzero(index["speech"][first:last])
+    if len(speaking) == 0:
+        return None
+    speech_start = (first + speaking[0]) * ANALYSIS_WINDOW
+    speech_end = (first + speaking[-1] + 1) * ANALYSIS_WINDOW
+    return max(start, speech_start - padding), min(end, speech_end + padding)
+
+
+def dead_air(index, start, end, min_duration=DEAD_AIR_MIN):
+    """Total duration of the silences longer than min_duration between start and end."""
+    first, last = index_range(index, start, end)
+    silent = np.concatenate([[False], ~index["speech"][first:last], [False]])
+    edges = np.flatnonzero(np.diff(silent.astype(np.int8)))
+    durations = (edges[1::2] - edges[::2]) * ANALYSIS_WINDOW
+    return float(durations[durations >= min_duration].sum())
+
+
+def format_timestamp(seconds):
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(int(minutes), 60)
+    return f"{hours:02d}:{minutes:02d}:{seconds:06.3f}"
+
+
+def segment_dead_air(segment):
+    if not os.path.exists(segment["video"]):
+        return None
+    start, end = segment["time"].strip().split("-")
+    return dead_air(audio_index(segment["video"]), to_seconds(start), to_seconds(end))
+
+
+def background_music_filter(config):
     timings = get_keyframe_timings(config)
     pairs = list(zip(timings[:-1], timings[1:]))
     ranges = [f"between(t,{start},{end})" for start, end in pairs]
@@ -540,10 +1989,8 @@ def create_background_music_file(config):
     disabled = "+".join(ranges[1::2])
     trim = round(timings[-1], 2)
     bgm = config["bgm"]
-    audio_file = os.path.abspath(bgm["audio"])
     ev = bgm["fg_volume"]
     dv = bgm["bg_volume"]
-    background = "background.m4a"
 
     # Fade in the music at the start
     st = timings[0]
@@ -551,7 +1998,7 @@ def create_background_music_file(config):
     afade = f"afade=t=in:st={st}:d={d}:curve=squ"
 
     af = (
-        f"[0:a]atrim=0:{trim},{afade},volume={ev}:enable='{enabled}',"
+        f"atrim=0:{trim},{afade},volume={ev}:enable='{enabled}',"
         f"volume={dv}:enable='{disabled}'"
     )
 
@@ -560,27 +2007,94 @@ def create_background_music_file(config):
     d = timings[-1] - st
     afade = f"afade=t=out:st={st}:d={d}:curve=qsin"
     af += f",{afade}"
+    return af
 
-    cmd = (
+
+def decode_pcm(input_file, output_file, sample_rate, channels=2):
+    """Decode the audio of a file to raw float samples, and memory map them."""
+    command = (
         FFMPEG_CMD
-        + ["-stream_loop", "100", "-i", audio_file]
-        + ["-af", af, "-c:a", "aac", background]
+        # The timestamps are regenerated, since the muxer rejects repeated ones
+        + ["-i", input_file, "-vn", "-af", "asetpts=N/SR/TB", "-f", "f32le"]
+        + ["-ar", str(sample_rate), "-ac", str(channels), output_file]
     )
-    print("Creating audio with volume enabled/disabled...")
-    subprocess.check_call(cmd)
-    return background
+    run_ffmpeg(command)
+    return np.memmap(output_file, dtype=np.float32, mode="r").reshape(-1, channels)
 
 
-@log_output_file
-def add_music_to_video(input_video, input_audio, output_video):
-    cmd = (
+def decoded_music(audio_file, sample_rate):
+    """The samples of the background music, decoded once into the cache and shared by projects."""
+    music_file = cache_path("pcm", cache_key(file_identity(audio_file), sample_rate), ".f32")
+    if not os.path.exists(music_file):
+        tmp_file = f"{os.path.splitext(music_file)[0]}-{tmp_id()}.tmp.f32"
+        decode_pcm(audio_file, tmp_file, sample_rate)
+        os.replace(tmp_file, music_file)
+    os.utime(music_file)
+    return np.memmap(music_file, dtype=np.float32, mode="r").reshape(-1, 2)
+
+
+def music_gain(t, timings, fg_volume, bg_volume):
+    """Gain of the background music at the times t, as applied by background_music_filter.
+
+    The music is at fg_volume during the cover and the questions, at
+    bg_volume during the answers, fades in over the cover and out over the
+    credits, and is trimmed at the end of the credits.
+
+    """
+    idx = np.searchsorted(timings, t, side="right") - 1
+    gain = np.where(idx % 2 == 0, fg_volume, bg_volume)
+    # afade's squ curve is a square root, and qsin a quarter sine wave
+    start, end = timings[0], timings[1]
+    fade_in = np.sqrt(np.clip((t - start) / max(end - start, 1e-9), 0, 1))
+    start, end = timings[-2], timings[-1]
+    fade_out = np.sin(np.clip((end - t) / max(end - start, 1e-9), 0, 1) * np.pi / 2)
+    return np.where(t < end, gain * fade_in * fade_out, 0)
+
+
+@traced
+def mix_background_music(input_video, config, output_video):
+    """Mix the background music into the audio of a video, stream copying its video.
+
+    Both are decoded to memory mapped samples once, and mixed in chunks with
+    the gain curve of the music, which is what the volume, afade and amix
+    filters would do. The IGTV (and review) copies of the video are rendered
+    by the same ffmpeg call that muxes the mixed audio.
+
+    """
+    bgm = config["bgm"]
+    timings = np.array(get_keyframe_timings(config))
+    sample_rate = int(audio_parameters(input_video)[0])
+    print("Mixing background music into video...")
+    foreground_file, mix_file = [f"{output_video}.{name}.f32" for name in ("foreground", "mix")]
+    foreground = decode_pcm(input_video, foreground_file, sample_rate)
+    music = decoded_music(os.path.abspath(bgm["audio"]), sample_rate)
+    mix = np.memmap(mix_file, dtype=np.float32, mode="w+", shape=foreground.shape)
+    for start in range(0, len(foreground), PCM_CHUNK_SAMPLES):
+        samples = np.arange(start, min(start + PCM_CHUNK_SAMPLES, len(foreground)))
+        gain = music_gain(samples / sample_rate, timings, bgm["fg_volume"], bgm["bg_volume"])
+        # The music is looped, and amix halves both its inputs
+        looped = music[samples % len(music)] * gain[:, None]
+        mix[samples] = np.clip((foreground[samples] + looped) / 2, -1, 1)
+    mix.flush()
+    del foreground, music, mix
+
+    # The video is copied as is, unless it uses an intermediate codec, and is
+    # only decoded for the copies of the video
+    size = video_dimensions(input_video)
+    copy_video = probe(input_video)["video_codec"] == "h264"
+    outputs = final_outputs(output_video, size, config.get("review_copy", False), copy_video)
+    filters = []
+    args = output_args(outputs, "0:v", "1:a", filters)
+    command = (
         FFMPEG_CMD
-        + ["-i", input_video, "-i", input_audio, "-async", "1"]
-        + ["-filter_complex", "[0][1]amix=inputs=2[a]"]
-        + ["-map", "[a]", "-map", "0:v", "-c:v", "copy", "-c:a", "aac", output_video]
+        + ["-i", input_video]
+        + ["-f", "f32le", "-ar", str(sample_rate), "-ac", "2", "-i", mix_file]
+        + ["-filter_complex", ";".join(filters)]
+        + args
     )
-    print("Adding background music to video...")
-    subprocess.check_call(cmd)
+    run_ffmpeg(command)
+    for path in (foreground_file, mix_file):
+        os.remove(path)
     return output_video
 
 
@@ -588,8 +2102,12 @@ def get_keyframe_timings(config):
     cover_time = config.get("cover", {}).get("time", 0)
     credits_time = config.get("credits", {}).get("time", 0)
     timings = []
+    probe_many(
+        part_filename(idx, clip["timings"][0]["video"])
+        for idx, clip in enumerate(config["clips"], start=1)
+    )
     for idx, clip in enumerate(config["clips"], start=1):
-        video = f"part-{idx:02d}-{clip['timings'][0]['video']}"
+        video = part_filename(idx, clip["timings"][0]["video"])
         duration = video_duration(video)  # includes intro slide time
         q = clip.get("question", "")
         a = clip.get("answer", "")
@@ -609,7 +2127,7 @@ def get_keyframe_timings(config):
 
 def get_music_filename(config):
     first_video = config["clips"][0]["timings"][0]["video"]
-    return f"ALL-music-{first_video}"
+    return profile_filename(f"ALL-music-{first_video}")
 
 
 @log_output_file
@@ -617,17 +2135,23 @@ def add_background_music(input_video, config):
     if "bgm" not in config:
         return input_video
 
-    background = create_background_music_file(config)
     output_video = get_music_filename(config)
-    add_music_to_video(input_video, background, output_video)
+    mix_background_music(input_video, config, output_video)
     return output_video
 
 
 @log_output_file
+@traced
 def threshold_audio(input_file, output_file, config):
     audio_threshold = config["audio_threshold"]
-    cmd = FFMPEG_CMD + ["-i", input_file] + ["-af", audio_threshold, "-c:v", "copy", output_file]
-    subprocess.check_call(cmd)
+    cmd = (
+        FFMPEG_CMD
+        + ["-i", input_file]
+        + ["-af", audio_threshold, "-c:v", "copy"]
+        + intermediate_args(output_file, video=False)
+        + [output_file]
+    )
+    run_ffmpeg(cmd)
     return output_file
 
 
@@ -655,6 +2179,549 @@ def youtube_chapters_text(config):
     return "\n".join(chapters)
 
 
+# The seconds are the duration of the video that a node decodes, and encodes
+# unless it only copies the video streams, and output is called like the
+# action, to name the file that it would build
+Node = namedtuple(
+    "Node",
+    ["deps", "params", "action", "args", "cost", "threads", "seconds", "output", "encodes"],
+    defaults=(1, 1, 0, None, True),
+)
+BUILD_STATE_FILE = ".build-state.json"
+TIMINGS_FILE = os.path.join(CACHE_DIR, "timings.json")
+TIMINGS_DECAY = 0.9
+DEFAULT_SECONDS_PER_COST = 0.5
+
+
+def build_segment(inputs, params, idx, sub_idx):
+    return create_video_segment(params, idx, sub_idx)
+
+
+def segment_output(inputs, params, idx, sub_idx):
+    return segment_filename(idx, sub_idx, params["video"])
+
+
+def build_intro(inputs, clip):
+    return prepare_question_video(inputs[0], get_question(clip))
+
+
+def intro_output(inputs, clip):
+    return slide_files(*question_slide(inputs[0], get_question(clip)))[0]
+
+
+def build_part(inputs, output_file):
+    print(f"Creating {output_file}")
+    return concat_videos(output_file, inputs)
+
+
+def part_output(inputs, output_file):
+    return output_file
+
+
+def build_part_graph(inputs, clip, with_intro, idx):
+    return process_clip_graph(clip, with_intro, idx)
+
+
+def part_graph_output(inputs, clip, with_intro, idx):
+    return part_filename(idx, clip["timings"][0]["video"])
+
+
+def output_cached(node, inputs):
+    """Whether the output of a segment, intro or credits node is in its cache."""
+    if node.action is build_segment:
+        return segment_cached(node.args[0])
+    if node.action is build_intro:
+        slide = question_slide(inputs[0], get_question(node.args[0]))
+    elif node.action is build_credits:
+        slide = credits_slide(inputs[0], node.args[0])
+    else:
+        return False
+    return os.path.exists(slide_files(*slide)[1])
+
+
+def build_cover(inputs, cover_config):
+    return create_cover(inputs[0], cover_config)
+
+
+def cover_output(inputs, cover_config):
+    w, h = slide_stream(inputs[0])[:2]
+    return cover_filename(w, h, os.path.splitext(inputs[0])[-1])
+
+
+def build_credits(inputs, credits):
+    print("Creating credits video...")
+    return create_credits_video(inputs[0], credits)
+
+
+def credits_output(inputs, credits):
+    return slide_files(*credits_slide(inputs[0], credits))[0]
+
+
+def build_concat(inputs, output_file):
+    return concat_videos(output_file, inputs, use_container=True)
+
+
+def concat_output(inputs, output_file):
+    return container_filename(output_file)
+
+
+def build_photos(inputs, photos):
+    return overlay_photos(inputs[0], photos)
+
+
+def photos_output(inputs, photos):
+    return photos_filename(inputs[0])
+
+
+def build_threshold(inputs, config):
+    return threshold_audio(inputs[0], threshold_output(inputs, config), config)
+
+
+def threshold_output(inputs, config):
+    return f"thresholded-{inputs[0]}"
+
+
+def build_music(inputs, config):
+    return add_background_music(inputs[0], config)
+
+
+def music_output(inputs, config):
+    return get_music_filename(config)
+
+
+def build_final(inputs, output_file, config):
+    return render_final(inputs, output_file, config)
+
+
+def final_output(inputs, output_file, config):
+    return output_file
+
+
+def build_copies(inputs, review):
+    return create_copies(inputs[0], review)
+
+
+def copies_output(inputs, review):
+    # Without an intermediate codec, the final video is the deliverable, and
+    # the IGTV copy comes first
+    output_file = delivery_filename(inputs[0])
+    return f"IGTV-{output_file}" if output_file == inputs[0] else output_file
+
+
+def frame_size():
+    """Width and height of the intermediate videos, or a guess before they are known."""
+    return INTERMEDIATE_SPEC.get("width", 1080), INTERMEDIATE_SPEC.get("height", 1080)
+
+
+def encode_cost(seconds, kind="encode"):
+    """Rough cost of a job, used to start the longest jobs first."""
+    width, height = frame_size()
+    megapixels = width * height / 1e6
+    if kind == "copy":
+        return seconds * 0.01
+    if kind == "audio":
+        return seconds * 0.05
+    if kind == "slide":
+        return seconds * megapixels * 0.5
+    return seconds * megapixels
+
+
+def job_threads(kind):
+    return thread_budget(kind, *frame_size())
+
+
+def encoder_threads(encoders):
+    """Threads for a job with several encoders, each getting the threads of a single encode."""
+    return min(job_threads("encode") * encoders, CPU_COUNT)
+
+
+def slide_assets():
+    """The logo and fonts that the slides are drawn with, which their nodes depend on."""
+    fonts = [font for font in ["Ubuntu-R.ttf", "UbuntuMono-B.ttf"] if os.path.exists(font)]
+    return [image_digest(LOGO_FILE), [file_identity(font) for font in fonts]]
+
+
+def clip_nodes(clip, idx, with_intro=True, engine="segments"):
+    """Nodes for the segments, the intro and the part of a single clip."""
+    nodes = {}
+    timings = clip["timings"]
+    part_file = part_filename(idx, timings[0]["video"])
+    part = f"part-{idx:02d}"
+    if engine == "graph":
+        sources = [file_identity(params["video"]) for params in timings]
+        params = [timings, sources, get_question(clip), with_intro, engine]
+        params += [INTERMEDIATE_SPEC, RENDER_PROFILE, slide_assets()]
+        seconds = get_clip_duration(clip)
+        args = [clip, with_intro, idx]
+        cost, threads = encode_cost(seconds), job_threads("encode")
+        nodes[part] = Node(
+            [], params, build_part_graph, args, cost, threads, seconds, part_graph_output
+        )
+        return nodes
+
+    segments = []
+    for sub_idx, params in enumerate(timings):
+        segment = f"segment-{idx:02d}-{sub_idx:02d}"
+        key = segment_cache_key(params)
+        seconds = get_segment_duration(params)
+        cost, threads = encode_cost(seconds), job_threads("encode")
+        args = [params, idx, sub_idx]
+        nodes[segment] = Node([], key, build_segment, args, cost, threads, seconds, segment_output)
+        segments.append(segment)
+    if with_intro:
+        intro = f"intro-{idx:02d}"
+        longest = segments[longest_segment_index(timings)]
+        q_a = get_question(clip)
+        seconds = get_time(f"{q_a.q} {q_a.a}")
+        cost, threads = encode_cost(seconds, "slide"), job_threads("slide")
+        params = [q_a, slide_assets()]
+        nodes[intro] = Node(
+            [longest], params, build_intro, [clip], cost, threads, seconds, intro_output
+        )
+        segments.insert(0, intro)
+    seconds = get_clip_duration(clip)
+    cost, threads = encode_cost(seconds, "copy"), job_threads("copy")
+    nodes[part] = Node(
+        segments, part_file, build_part, [part_file], cost, threads, seconds, part_output, False
+    )
+    return nodes
+
+
+def build_graph(config, with_intro=True, engine="segments", single_pass=False):
+    """Model every artifact of the video as a node in a dependency graph.
+
+    The nodes are returned in topological order. Each node's params
+    fingerprint everything other than its dependencies that its output
+    depends on.
+
+    """
+    nodes = {}
+    parts = []
+    review = config.get("review_copy", False)
+    for idx, clip in enumerate(config["clips"], start=1):
+        nodes.update(clip_nodes(clip, idx, with_intro, engine))
+        parts.append(f"part-{idx:02d}")
+    total = sum(get_clip_duration(clip) for clip in config["clips"])
+
+    first = parts[0]
+    deps = list(parts)
+    cover_config = config.get("cover")
+    if cover_config:
+        params = [cover_config, file_identity(cover_config["image"]), slide_assets()]
+        seconds = cover_config["time"]
+        cost, threads = encode_cost(seconds, "slide"), job_threads("slide")
+        nodes["cover"] = Node(
+            [first], params, build_cover, [cover_config], cost, threads, seconds, cover_output
+        )
+        deps.insert(0, "cover")
+    credits = config.get("credits")
+    if credits:
+        seconds = credits.get("time", 2 + len(credits) * 2)
+        cost, threads = encode_cost(seconds, "slide"), job_threads("slide")
+        params = [credits, slide_assets()]
+        nodes["credits"] = Node(
+            [first], params, build_credits, [credits], cost, threads, seconds, credits_output
+        )
+        deps.append("credits")
+
+    first_file = part_filename(1, config["clips"][0]["timings"][0]["video"])
+    output_file = f"ALL-{first_file}"
+    if single_pass:
+        photos = config.get("photos", [])
+        bgm = config.get("bgm")
+        output_file = get_music_filename(config) if bgm else delivery_filename(output_file)
+        params = [
+            output_file,
+            photos,
+            [file_identity(photo["photo"]) for photo in photos],
+            config.get("audio_threshold"),
+            [bgm, file_identity(bgm["audio"])] if bgm else None,
+        ]
+        params.append(review)
+        cost, threads = encode_cost(total) * (2 + review), encoder_threads(2 + review)
+        args = [output_file, config]
+        nodes["final"] = Node(deps, params, build_final, args, cost, threads, total, final_output)
+        return nodes
+
+    cost = encode_cost(total, "copy")
+    nodes["concat"] = Node(
+        deps,
+        output_file,
+        build_concat,
+        [output_file],
+        cost,
+        job_threads("copy"),
+        total,
+        concat_output,
+        False,
+    )
+    last = "concat"
+
+    photos = config.get("photos")
+    if photos:
+        params = [photos, [file_identity(photo["photo"]) for photo in photos]]
+        cost = encode_cost(total)
+        threads = job_threads("encode")
+        nodes["photos"] = Node(
+            [last], params, build_photos, [photos], cost, threads, total, photos_output
+        )
+        last = "photos"
+
+    if "audio_threshold" in config:
+        params, cost = config["audio_threshold"], encode_cost(total, "audio")
+        threads = job_threads("audio")
+        nodes["threshold"] = Node(
+            [last], params, build_threshold, [config], cost, threads, total, threshold_output, False
+        )
+        last = "threshold"
+
+    # The copies are rendered along with the music, or from the last step without it,
+    # and the final video is only encoded again if it has an intermediate codec
+    encoders = 1 + review + (INTERMEDIATE_SPEC.get("video_codec", "h264") != "h264")
+    cost, threads = encode_cost(total) * encoders, encoder_threads(encoders)
+    if "bgm" in config:
+        bgm = config["bgm"]
+        params = [bgm, file_identity(bgm["audio"]), review]
+        cost += encode_cost(total, "audio")
+        nodes["bgm"] = Node(
+            [last, *parts], params, build_music, [config], cost, threads, total, music_output
+        )
+    else:
+        nodes["copies"] = Node(
+            [last], review, build_copies, [review], cost, threads, total, copies_output
+        )
+    return nodes
+
+
+def run_node(name, node, inputs):
+    """Run the action of a node, with its ffmpeg calls limited to its threads.
+
+    Returns the output of the node, the seconds it took, or None if it
+    didn't run ffmpeg, like when its output was in a cache, and the events
+    it traced if it ran in a worker process.
+
+    """
+    JOB_CONTEXT.name, JOB_CONTEXT.cost, JOB_CONTEXT.threads = name, node.cost, node.threads
+    JOB_CONTEXT.encoded = False
+    start = time.time()
+    try:
+        with trace_span(name, "target"):
+            output = node.action(inputs, *node.args)
+        return output, time.time() - start if JOB_CONTEXT.encoded else None, drain_trace()
+    finally:
+        JOB_CONTEXT.name, JOB_CONTEXT.cost, JOB_CONTEXT.threads = None, 0, None
+
+
+def graph_fingerprints(nodes):
+    """Fingerprint of each node, from its params and the fingerprints of its dependencies."""
+    fingerprints = {}
+    for name, node in nodes.items():
+        fingerprints[name] = cache_key(node.params, [fingerprints[dep] for dep in node.deps])
+    return fingerprints
+
+
+def target_kind(name, node):
+    """The kind of a target, like segment or bgm, along with the settings its timings depend on.
+
+    Those are whether it encodes the video or only copies it, since parts are
+    encoded by the graph engine but concatenated from their segments
+    otherwise, and the render profile and codec.
+
+    """
+    kind = name.split("/")[-1].split("-")[0]
+    mode = "encode" if node.encodes else "copy"
+    return f"{kind}/{mode}/{RENDER_PROFILE.get('name')}/{INTERMEDIATE_SPEC.get('video_codec')}"
+
+
+def load_timings():
+    if not os.path.exists(TIMINGS_FILE):
+        return {}
+    with open(TIMINGS_FILE) as f:
+        return json.load(f)
+
+
+def record_timings(timings):
+    """Add the seconds that targets took to build, per unit of their cost, to the cost model.
+
+    Older timings decay, so that the model follows changes in the encoder
+    settings and the hardware.
+
+    """
+    if not timings:
+        return
+    model = load_timings()
+    for kind, cost, seconds in timings:
+        total_seconds, total_cost = model.get(kind, [0, 0])[:2]
+        model[kind] = [
+            total_seconds * TIMINGS_DECAY + seconds,
+            total_cost * TIMINGS_DECAY + cost,
+        ]
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    save_json(TIMINGS_FILE, model)
+
+
+def seconds_per_cost(model, kind):
+    """Estimated seconds per unit of cost for a kind of target, from its past timings."""
+    total_seconds, total_cost = model.get(kind, [0, 0])[:2]
+    if total_cost > 0:
+        return total_seconds / total_cost
+    # Fall back to all the timings of the same mode, render profile and codec, or a rough guess
+    settings = kind.partition("/")[2]
+    similar = [value for kind, value in model.items() if kind.partition("/")[2] == settings]
+    total_seconds = sum(value[0] for value in similar)
+    total_cost = sum(value[1] for value in similar)
+    return total_seconds / total_cost if total_cost > 0 else DEFAULT_SECONDS_PER_COST
+
+
+def predict_wall_time(nodes, durations, max_threads=CPU_COUNT):
+    """Simulate run_graph, starting the longest ready nodes first within the thread budget."""
+    clock, available, done, running = 0, max_threads, set(), []
+    pending = list(nodes)
+    while pending or running:
+        ready = [name for name in pending if all(dep in done for dep in nodes[name].deps)]
+        ready.sort(key=lambda name: nodes[name].cost, reverse=True)
+        for name in ready:
+            threads = min(nodes[name].threads, max_threads)
+            if threads <= available:
+                pending.remove(name)
+                available -= threads
+                heapq.heappush(running, (clock + durations[name], name, threads))
+        if not running:
+            break
+        clock, name, threads = heapq.heappop(running)
+        done.add(name)
+        available += threads
+    return clock
+
+
+def run_graph(
+    nodes,
+    max_threads=CPU_COUNT,
+    max_jobs=None,
+    state_files=None,
+    pool=ThreadPoolExecutor,
+    calibrate=True,
+):
+    """Run the actions of the out of date nodes, running independent ones in parallel.
+
+    A node is out of date if its fingerprint, computed from its params and the
+    fingerprints of its dependencies, has changed since the last build, if its
+    output is missing, or if any of its dependencies were rebuilt.
+
+    Nodes whose dependencies are done are started in order of their cost,
+    longest first, as long as the total threads of the running nodes stay
+    within max_threads. If a node fails, the running nodes are cancelled
+    and no more nodes are started. The nodes are run on threads, or on the
+    workers of the given pool. The time taken by the nodes that ran ffmpeg
+    calibrates the cost model used by plan, unless calibrate is False.
+
+    The state of the nodes is kept in the state files given by the prefix of
+    their names, by default in .build-state.json for all of them, with their
+    outputs relative to the directory of the state file.
+
+    """
+    state_files = state_files or {"": BUILD_STATE_FILE}
+    state = {}
+    for prefix, state_file in state_files.items():
+        if not os.path.exists(state_file):
+            continue
+        with open(state_file) as f:
+            for name, entry in json.load(f).items():
+                output = os.path.join(os.path.dirname(state_file), entry["output"])
+                state[f"{prefix}{name}"] = dict(entry, output=output)
+
+    fingerprints = graph_fingerprints(nodes)
+
+    def is_stale(name):
+        entry = state.get(name)
+        return (
+            entry is None
+            or entry["fingerprint"] != fingerprints[name]
+            or not os.path.exists(entry["output"])
+            or any(dep in rebuilt for dep in nodes[name].deps)
+        )
+
+    def save_state(name):
+        prefix = next(prefix for prefix in state_files if name.startswith(prefix))
+        state_file = state_files[prefix]
+        entries = {
+            name[len(prefix) :]: dict(
+                entry, output=os.path.relpath(entry["output"], os.path.dirname(state_file) or ".")
+            )
+            for name, entry in state.items()
+            if name.startswith(prefix)
+        }
+        with open(f"{state_file}.tmp", "w") as f:
+            json.dump(entries, f, indent=2)
+        os.replace(f"{state_file}.tmp", state_file)
+
+    outputs, rebuilt, running, errors, timings = {}, set(), {}, [], []
+    pending, ready = list(nodes), []
+    available = max_threads
+    JOB_FAILED.clear()
+    PROGRESS.update(total=0, done=0)
+    with pool(max_workers=max_jobs or max_threads) as executor:
+        while pending or ready or running:
+            unblocked = [
+                name for name in pending if all(dep in outputs for dep in nodes[name].deps)
+            ]
+            for name in unblocked:
+                pending.remove(name)
+                if is_stale(name):
+                    ready.append(name)
+                    PROGRESS["total"] += nodes[name].cost
+                else:
+                    outputs[name] = state[name]["output"]
+            if any(name in outputs for name in unblocked):
+                continue
+
+            if errors:
+                pending, ready = [], []
+            ready.sort(key=lambda name: nodes[name].cost, reverse=True)
+            for name in list(ready):
+                threads = min(nodes[name].threads, max_threads)
+                if threads > available or len(running) == (max_jobs or max_threads):
+                    continue
+                ready.remove(name)
+                available -= threads
+                node = nodes[name]._replace(threads=threads)
+                inputs = [outputs[dep] for dep in node.deps]
+                running[executor.submit(run_node, name, node, inputs)] = name
+            if errors and not running:
+                break
+            assert running, f"Unable to build {', '.join(pending)}: cyclic dependencies"
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                available += min(nodes[name].threads, max_threads)
+                PROGRESS["done"] += nodes[name].cost
+                if future.exception():
+                    cancel_jobs()
+                    errors.append((name, future.exception()))
+                    continue
+                output, seconds, events = future.result()
+                if events:
+                    TRACE["events"].extend(events)
+                if seconds is not None:
+                    timings.append((target_kind(name, nodes[name]), nodes[name].cost, seconds))
+                outputs[name] = output
+                rebuilt.add(name)
+                state[name] = {"fingerprint": fingerprints[name], "output": output}
+                save_state(name)
+            show_progress()
+
+    clear_progress()
+    if calibrate:
+        record_timings(timings)
+    failed = [(name, error) for name, error in errors if not isinstance(error, JobCancelled)]
+    if failed:
+        name, error = failed[0]
+        raise RuntimeError(f"Failed to build {name}") from error
+    print(f"Rebuilt {len(rebuilt)} of {len(nodes)} targets")
+    return outputs
+
+
 def upload_to_youtube(upload_file, cover_image, title, description):
     options = FirefoxOptions()
     profile_dir = os.environ["FF_PROFILE"]
@@ -692,77 +2759,238 @@ def upload_to_instagram(upload_file, cover_image, title, description):
     element.send_keys(cover_image)
 
 
-@click.group()
-@click.option("--loglevel", default="error")
-@click.option("--profile/--no-profile", default=False)
-@click.option("--use-original/--use-low-res", default=False)
-@click.argument("config_file", type=click.File())
-@click.pass_context
-def cli(ctx, config_file, use_original, profile, loglevel):
-    FFMPEG_CMD.extend(["-v", loglevel])
+def load_config(config_file, use_original, render_profile=None, cache_size=None):
+    """Load the config of a project, and switch to the directory with its media."""
     config_data = yaml.load(config_file, Loader=yaml.FullLoader) or {}
+    if cache_size is not None:
+        config_data["cache_size"] = cache_size
+    config_data.setdefault("cache_size", CACHE_SIZE_GB)
+    default_profile = "delivery" if use_original else "review"
+    set_render_profile(render_profile or config_data.get("render_profile", default_profile))
     config_data["config_file"] = os.path.abspath(config_file.name)
     process_config(config_data, use_original)
     name = os.path.basename(os.path.splitext(config_file.name)[0])
     config_data["name"] = name
     input_dir = os.path.join(os.path.abspath("media"), name)
     os.chdir(input_dir)
+    return config_data
+
+
+def run_options(fn):
+    """Options of the commands run from the command line, for one or several projects."""
+    fn = click.option(
+        "--trace",
+        type=click.Path(dir_okay=False),
+        default=None,
+        help="Write a Chrome trace JSON of all the stages and ffmpeg calls to this file",
+    )(fn)
+    fn = click.option(
+        "--render-profile",
+        type=click.Choice(list(RENDER_PROFILES)),
+        default=None,
+        help="Encoder settings to use (default: delivery for originals, review for low res)",
+    )(fn)
+    fn = click.option("--cache-size", type=float, help="Segment cache budget in GB")(fn)
+    fn = click.option("--use-original/--use-low-res", default=False)(fn)
+    fn = click.option("--profile/--no-profile", default=False)(fn)
+    return click.option("--loglevel", default="error")(fn)
+
+
+def start_run(ctx, loglevel, profile, trace):
+    """Set up the ffmpeg log level, and the tracing and profiling of the run."""
+    FFMPEG_CMD.extend(["-v", loglevel])
+    if trace:
+        start_tracing()
+        ctx.call_on_close(functools.partial(write_trace, os.path.abspath(trace)))
     if profile:
         profile = cProfile.Profile()
         profile.enable()
-        config_data["profile"] = profile
+        ctx.call_on_close(functools.partial(profile.dump_stats, os.path.abspath("profile.out")))
+
+
+@click.group()
+@run_options
+@click.argument("config_file", type=click.File())
+@click.pass_context
+def cli(ctx, use_original, profile, loglevel, cache_size, trace, render_profile, config_file):
+    start_run(ctx, loglevel, profile, trace)
+    config_data = load_config(config_file, use_original, render_profile, cache_size)
     config_data["debug"] = loglevel != "error"
     ctx.obj.update(config_data)
 
 
+def clip_options(with_intro=False):
+    """Options of the commands that render the clips."""
+
+    def decorator(fn):
+        fn = click.option(
+            "--engine",
+            type=click.Choice(["segments", "graph"]),
+            default="segments",
+            help="Render each clip from cached segments, or in a single ffmpeg pass",
+        )(fn)
+        return click.option("--with-intro/--no-intro", default=with_intro)(fn)
+
+    return decorator
+
+
+def final_options(fn):
+    """Options of the commands that render the final video."""
+    fn = click.option(
+        "--review-copy/--no-review-copy",
+        default=None,
+        help="Also render a low res copy of the final video for review",
+    )(fn)
+    return click.option(
+        "--single-pass/--multi-pass",
+        default=False,
+        help="Render the final video with a single encode, instead of one per step",
+    )(fn)
+
+
+def build_options(fn):
+    """Options of the commands that build all the targets of the video."""
+    fn = click.option(
+        "-j", "--threads", default=CPU_COUNT, help="Total threads for the ffmpeg jobs"
+    )(fn)
+    return clip_options(with_intro=True)(final_options(fn))
+
+
 @cli.command()
 @click.option("--multi-process/--single-process", default=True)
-@click.option("--with-intro/--no-intro", default=False)
+@clip_options()
 @click.option("-n", default=0)
 @click.pass_context
-def process_clips(ctx, n, with_intro, multi_process):
+def process_clips(ctx, n, with_intro, multi_process, engine):
     config = ctx.obj
+    render_clips(config, n, with_intro, engine, max_jobs=None if multi_process else 1)
+    evict_cache(config["cache_size"])
+
+
+def render_clips(config, n, with_intro, engine, max_jobs=None):
+    """Render the parts of all the clips, or only the n-th one, and return the built targets."""
     clips = config["clips"]
-    cpu_count = max(1, multiprocessing.cpu_count() - 1)
+    probe_many(params["video"] for clip in clips for params in clip["timings"])
+    set_intermediate_spec(config)
+    prepare_image_assets(project_image_assets(config))
+    prefetch_screenshots([clip for idx, clip in enumerate(clips, start=1) if n in {0, idx}], engine)
 
     if n == 0 and not with_intro:
         print("Intros will be generated even though --with-intro is off ...")
         with_intro = True
-        # Generate black background before processing the clips
-        timing = clips[0]["timings"][0]
-        input_file = timing["video"]
-        output_file = f"black-input-{input_file}"
-        split_video(input_file, output_file, "0:0", "0:20", timing["crop"])
-        create_black_background(output_file)
-
-    if n > 0:
-        process_clip(clips[n - 1], with_intro, n)
-    elif cpu_count == 1 or not multi_process:
-        for idx, clip in enumerate(clips, start=1):
-            process_clip(clip, with_intro, idx)
-    else:
-        pool = multiprocessing.Pool(processes=cpu_count)
-        n = len(clips) + 1
-        args = zip(clips, n * [with_intro], range(1, n + 1))
-        pool.starmap(process_clip, args)
 
-    if "profile" in config:
-        profile = config["profile"]
-        profile.dump_stats("profile.out")
+    nodes = {}
+    for idx, clip in enumerate(clips, start=1):
+        if n in {0, idx}:
+            nodes.update(clip_nodes(clip, idx, with_intro, engine))
+    return run_graph(nodes, max_jobs=max_jobs)
+
+
+def diff_clips(old_clips, new_clips):
+    """Describe the changes to each clip, between two versions of the config."""
+    changes = {}
+    for idx, clip in enumerate(new_clips, start=1):
+        if idx > len(old_clips):
+            changes[idx] = "new clip"
+            continue
+        old = old_clips[idx - 1]
+        if clip == old:
+            continue
+        old_timings = old["timings"]
+        segments = [
+            str(sub_idx)
+            for sub_idx, params in enumerate(clip["timings"], start=1)
+            if sub_idx > len(old_timings) or params != old_timings[sub_idx - 1]
+        ]
+        details = [f"segments {', '.join(segments)}"] if segments else []
+        if len(clip["timings"]) < len(old_timings):
+            details.append("removed segments")
+        if get_question(clip) != get_question(old):
+            details.append("question")
+        changes[idx] = ", ".join(details) or "changed"
+    return changes
+
+
+@cli.command()
+@clip_options()
+@click.option("--interval", default=0.5, help="Seconds between checks for changes")
+@click.option("-n", default=0)
+@click.pass_context
+def watch(ctx, n, with_intro, engine, interval):
+    """Re-render the clips that change, whenever the config file is saved.
+
+    The process stays running between the edits, so the probes and the
+    audio and image caches stay in memory, and only the changed segments,
+    intros and parts are rendered again.
+
+    """
+    config = ctx.obj
+    config_file = config["config_file"]
+    params = ctx.parent.params
+    # The media directory of the project is media/<name> in the root
+    root = os.path.dirname(os.path.dirname(os.getcwd()))
+    clips, mtime = [], None
+    print(f"Watching {config_file} for changes, press Ctrl+C to stop...")
+    while True:
+        # A failed render leaves the jobs cancelled until they are cleared
+        JOB_FAILED.clear()
+        try:
+            if os.stat(config_file).st_mtime_ns == mtime:
+                time.sleep(interval)
+                continue
+            mtime = os.stat(config_file).st_mtime_ns
+            os.chdir(root)
+            with open(config_file) as f:
+                config = load_config(
+                    f, params["use_original"], params["render_profile"], params["cache_size"]
+                )
+            changes = diff_clips(clips, config["clips"])
+            if not changes:
+                continue
+            for idx, change in changes.items() if clips else ():
+                print(f"Clip {idx}: {change}")
+            new_clips = copy.deepcopy(config["clips"])
+            start = time.time()
+            outputs = render_clips(config, n, with_intro, engine)
+            # Clips are only up to date once rendered, so failed ones are retried on the next save
+            clips = new_clips
+            for idx in changes:
+                if f"part-{idx:02d}" in outputs:
+                    print(f"Updated {os.path.abspath(outputs[f'part-{idx:02d}'])}")
+            print(f"Rendered in {time.time() - start:.1f}s, waiting for changes...")
+        except KeyboardInterrupt:
+            break
+        except Exception as e:
+            clear_progress()
+            print(BOLDRED, f"ERROR: {e}", ENDC, sep="", file=sys.stderr)
+            # Errors before the config is read again, like while it's being saved, would
+            # otherwise repeat without a pause
+            try:
+                time.sleep(interval)
+            except KeyboardInterrupt:
+                break
+    evict_cache(config["cache_size"])
 
 
 @cli.command()
+@final_options
 @click.pass_context
-def combine_clips(ctx):
+def combine_clips(ctx, single_pass, review_copy):
     config = ctx.obj
+    if review_copy is not None:
+        config["review_copy"] = review_copy
+    # The spec decides the container, and so the names of the parts
+    set_intermediate_spec(config)
     video_names = [
-        f"part-{idx:02d}-{clip['timings'][0]['video']}"
+        part_filename(idx, clip["timings"][0]["video"])
         for idx, clip in enumerate(config["clips"], start=1)
     ]
     missing_names = {name for name in video_names if not os.path.exists(name)}
     if missing_names:
         names = ", ".join(missing_names)
         raise RuntimeError(f"Create {names} before creating combined video")
+    probe_many(video_names)
+    prepare_image_assets(project_image_assets(config))
 
     names = ", ".join(video_names)
     print(f"Combining {names} into a single video...")
@@ -771,18 +2999,8 @@ def combine_clips(ctx):
 
     cover_config = config.get("cover")
     if cover_config:
-        print("Creating cover video...")
-        width, height = video_dimensions(first)
-        ext = os.path.splitext(first)[-1]
-        cover_config["width"] = width
-        cover_config["height"] = height
-        cover_video = create_cover_video(cover_config, ext)
+        cover_video = create_cover(first, cover_config)
         video_names.insert(0, cover_video)
-        # Create padded cover image
-        print("Creating IGTV cover image...")
-        cover_image = cover_config["image"]
-        igtv_cover = f"IGTV-{cover_image}"
-        create_igtv_video(cover_image, igtv_cover)
     else:
         print(BOLDRED, "WARNING: No cover image has been specified!", ENDC, sep="")
 
@@ -792,6 +3010,14 @@ def combine_clips(ctx):
         credits_video = create_credits_video(first, credits)
         video_names.append(credits_video)
 
+    if single_pass:
+        if "bgm" in config:
+            output_file = get_music_filename(config)
+        else:
+            output_file = delivery_filename(output_file)
+        render_final(video_names, output_file, config)
+        return
+
     output_file = concat_videos(output_file, video_names, use_container=True)
 
     # Add image slideshow
@@ -804,12 +3030,106 @@ def combine_clips(ctx):
         threshold_file = f"thresholded-{output_file}"
         output_file = threshold_audio(output_file, threshold_file, config)
 
-    # Create musical version of video
-    output_file = add_background_music(output_file, config)
+    # Create musical version of video, along with its copies
+    if "bgm" in config:
+        add_background_music(output_file, config)
+    else:
+        create_copies(output_file, config.get("review_copy", False))
 
-    print("Creating IGTV video...")
-    igtv_file = os.path.abspath(f"IGTV-{output_file}")
-    create_igtv_video(output_file, igtv_file)
+
+@cli.command()
+@build_options
+@click.pass_context
+def build(ctx, with_intro, engine, single_pass, review_copy, threads):
+    """Build only the out of date parts of the video, and everything depending on them."""
+    config = ctx.obj
+    if review_copy is not None:
+        config["review_copy"] = review_copy
+    probe_many(params["video"] for clip in config["clips"] for params in clip["timings"])
+    set_intermediate_spec(config)
+    prepare_image_assets(project_image_assets(config))
+    prefetch_screenshots(config["clips"], engine)
+    nodes = build_graph(config, with_intro, engine, single_pass)
+    run_graph(nodes, threads)
+    evict_cache(config["cache_size"])
+
+
+def node_sources(node):
+    """The source videos of a node without dependencies."""
+    sources = []
+    for arg in node.args:
+        if isinstance(arg, dict) and "video" in arg:
+            sources.append(arg["video"])
+        elif isinstance(arg, dict) and "timings" in arg:
+            sources.extend(params["video"] for params in arg["timings"])
+    return sorted(set(sources))
+
+
+def plan_graph(nodes, state):
+    """The status and the estimated seconds of each node, if it were built now.
+
+    Nodes are up to date like in run_graph, and segments and slides that are
+    stale but in their cache only need to be linked, which takes no time.
+
+    """
+    fingerprints = graph_fingerprints(nodes)
+    model = load_timings()
+    plan, outputs = {}, {}
+    for name, node in nodes.items():
+        inputs = [outputs[dep] for dep in node.deps]
+        outputs[name] = node.output(inputs, *node.args)
+        entry = state.get(name)
+        if (
+            entry is not None
+            and entry["fingerprint"] == fingerprints[name]
+            and os.path.exists(entry["output"])
+            and all(plan[dep]["status"] == "up to date" for dep in node.deps)
+        ):
+            status, seconds = "up to date", 0
+        elif output_cached(node, inputs):
+            status, seconds = "cached", 0
+        else:
+            kind = target_kind(name, node)
+            status, seconds = "render", node.cost * seconds_per_cost(model, kind)
+        plan[name] = {"status": status, "seconds": seconds, "output": outputs[name]}
+    return plan
+
+
+@cli.command()
+@build_options
+@click.pass_context
+def plan(ctx, with_intro, engine, single_pass, review_copy, threads):
+    """Show the targets that build would render, and estimate how long it would take."""
+    config = ctx.obj
+    if review_copy is not None:
+        config["review_copy"] = review_copy
+    probe_many(params["video"] for clip in config["clips"] for params in clip["timings"])
+    set_intermediate_spec(config)
+    nodes = build_graph(config, with_intro, engine, single_pass)
+    state = {}
+    if os.path.exists(BUILD_STATE_FILE):
+        with open(BUILD_STATE_FILE) as f:
+            state = json.load(f)
+    plan = plan_graph(nodes, state)
+
+    print("Target\tInputs\tOutput\tStatus\tVideo (s)\tThreads\tEstimate (s)")
+    for name, node in nodes.items():
+        step = plan[name]
+        inputs = ", ".join(node.deps or node_sources(node)) or "-"
+        print(
+            f"{name}\t{inputs}\t{step['output']}\t{step['status']}\t{node.seconds:.1f}"
+            f"\t{node.threads}\t{step['seconds']:.1f}"
+        )
+
+    render = [name for name in nodes if plan[name]["status"] == "render"]
+    cached = [name for name in nodes if plan[name]["status"] == "cached"]
+    # Only the targets that encode the video decode it, the others copy its streams
+    seconds = sum(nodes[name].seconds for name in render if nodes[name].encodes)
+    print(f"{len(render)} of {len(nodes)} targets to render, {len(cached)} from the cache")
+    print(f"Video to decode and encode: {seconds:.1f}s")
+    wall_time = predict_wall_time(nodes, {name: plan[name]["seconds"] for name in nodes}, threads)
+    source = "timings of past builds" if load_timings() else "default estimates, until a build"
+    print(f"Predicted wall time with {threads} threads: {wall_time:.0f}s (from {source})")
 
 
 @cli.command()
@@ -820,13 +3140,16 @@ def make_trailer(ctx):
         click.echo("No configuration found for trailer!")
         return
     click.echo("Making trailer...")
-    segments = create_video_segments(config["trailer"], 0, [])
+    set_intermediate_spec(config)
+    segments = create_video_segments(config["trailer"], 0)
     video = config["video"]
-    output_file = f"trailer-{video}"
+    output_file = intermediate_filename(profile_filename(f"trailer-{video}"))
     concat_videos(output_file, segments)
+    evict_cache(config["cache_size"])
     if "audio_threshold" in config:
         threshold_file = f"thresholded-{output_file}"
-        threshold_audio(output_file, threshold_file, config)
+        output_file = threshold_audio(output_file, threshold_file, config)
+    encode_delivery(output_file)
 
 
 @cli.command()
@@ -836,13 +3159,13 @@ def populate_config(ctx, video_format):
     config = ctx.obj
     videos = sorted(glob.glob(f"*.{video_format}"))
     name = config.pop("name")
-    low_res_map = {}
-    for idx, video in enumerate(videos, start=1):
-        output_file = f"{name}-{idx:02d}.{video_format}"
-        create_low_res(video, output_file)
-        low_res_map[video] = output_file
+    low_res_map = {
+        video: f"{name}-{idx:02d}.{video_format}" for idx, video in enumerate(videos, start=1)
+    }
+    create_proxies(low_res_map)
 
     config_file = config.pop("config_file")
+    config.pop("cache_size")
     config["clips"] = []
     config["video"] = videos[0]
     config["alt_low_res"] = low_res_map
@@ -855,21 +3178,51 @@ def populate_config(ctx, video_format):
 def print_index(ctx):
     config = ctx.obj
     clips = config["clips"]
-    print("No.\tQuestion & Answer\tDuration (s)\tQ time (s)")
+    print("No.\tQuestion & Answer\tDuration (s)\tQ time (s)\tDead air (s)")
     total_duration = 0
     for idx, clip in enumerate(clips, start=1):
         duration = get_clip_duration(clip)
         text = " + ".join(filter(None, [clip.get("question", ""), clip.get("answer")]))
         q_time = get_time(text.strip().strip("|").strip())
-        print(f"{idx}\t{text}\t{duration:.1f}\t{q_time}")
+        silences = [segment_dead_air(segment) for segment in clip["timings"]]
+        silence = "-" if None in silences else f"{sum(silences):.1f}"
+        print(f"{idx}\t{text}\t{duration:.1f}\t{q_time}\t{silence}")
         total_duration += duration + q_time
     print(f"Total duration: {total_duration}")
 
 
+@cli.command()
+@click.option("--padding", default=TRIM_PADDING, help="Seconds to keep around the speech")
+@click.option("-n", default=0)
+@click.pass_context
+def analyze_audio(ctx, padding, n):
+    """Suggest tighter trims for the segments, based on the speech in them."""
+    config = ctx.obj
+    clips = config["clips"]
+    print("No.\tSegment\tVideo\tTime\tSuggested time\tDead air (s)")
+    for idx, clip in enumerate(clips, start=1):
+        if n and idx != n:
+            continue
+        for sub_idx, segment in enumerate(clip["timings"], start=1):
+            video = segment["video"]
+            start, end = (to_seconds(t) for t in segment["time"].strip().split("-"))
+            index = audio_index(video)
+            trim = suggest_trim(index, start, end, padding)
+            if trim is None:
+                suggested = "silent"
+            elif trim[0] - start < ANALYSIS_WINDOW and end - trim[1] < ANALYSIS_WINDOW:
+                suggested = "-"
+            else:
+                suggested = "-".join(format_timestamp(t) for t in trim)
+            silence = dead_air(index, start, end)
+            print(f"{idx}\t{sub_idx}\t{video}\t{segment['time']}\t{suggested}\t{silence:.1f}")
+
+
 @cli.command()
 @click.pass_context
 @click.argument("video", type=click.File())
 def add_music(ctx, video):
+    set_intermediate_spec(ctx.obj)
     add_background_music(video.name, ctx.obj)
 
 
@@ -879,6 +3232,7 @@ def add_music(ctx, video):
 def add_photos(ctx, video):
     photos = ctx.obj.get("photos")
     if photos:
+        set_intermediate_spec(ctx.obj)
         output_file = overlay_photos(video.name, photos)
 
 
@@ -894,7 +3248,6 @@ def clean_workdir(ctx):
             "segment-",
             "black-",
             "thresholded-",
-            "background.m4a",
         }
         for path in glob.glob(f"{prefix}*")
     ]
@@ -911,7 +3264,7 @@ def project_add_video(ctx, video):
     n = len(config["alt_low_res"]) + 1
     name = config["name"]
     output_file = f"{name}-{n:02d}{ext}"
-    create_low_res(video.name, output_file)
+    create_proxies({video.name: output_file})
 
 
 @cli.command()
@@ -921,7 +3274,7 @@ def create_flac_audio(ctx):
     for key in config["alt_low_res"]:
         command = FFMPEG_CMD + ["-i", key, "-ac", "1", "-vn", f"{key}.flac"]
         print(f"Creating Flac audio for {key}...")
-        subprocess.check_call(command)
+        run_ffmpeg(command)
 
 
 @cli.command()
@@ -941,6 +3294,7 @@ def gs_upload_flac_audio(ctx):
 @click.pass_context
 def youtube_chapters(ctx):
     config = ctx.obj
+    set_intermediate_spec(config)
     chapters = youtube_chapters_text(config)
     print(chapters)
 
@@ -950,6 +3304,7 @@ def youtube_chapters(ctx):
 def youtube_upload(ctx):
     config = ctx.obj
     assert ctx.parent.params["use_original"], "Please call the command with use original"
+    set_intermediate_spec(config)
     # FIXME: We assume we are only going to upload videos with music, which is
     # good enough for now!
     upload_file = os.path.abspath(get_music_filename(config))
@@ -978,5 +3333,96 @@ def instagram_upload(ctx):
     upload_to_instagram(upload_file, cover_image, title, description)
 
 
+def start_batch_worker(ffmpeg_cmd, trace):
+    FFMPEG_CMD[:] = ffmpeg_cmd
+    # A forked worker can't use the runner of the scheduler. The scheduler
+    # shows the progress of the targets done by the workers, and gathers the
+    # events they trace, with its clock
+    RUNNER.clear()
+    JOB_FAILED.clear()
+    TRACE.update(trace)
+    PROGRESS.update(jobs={}, shown=math.inf)
+
+
+def run_in_project(project, action, inputs, *args):
+    """Run the action of a node of a project, in its directory and with its settings."""
+    os.chdir(project["dir"])
+    INTERMEDIATE_SPEC.clear()
+    INTERMEDIATE_SPEC.update(project["spec"])
+    RENDER_PROFILE.clear()
+    RENDER_PROFILE.update(project["profile"])
+    inputs = [os.path.relpath(path) for path in inputs]
+    return os.path.abspath(action(inputs, *args))
+
+
+@click.command()
+@run_options
+@build_options
+@click.argument("config_files", type=click.File(), nargs=-1, required=True)
+@click.pass_context
+def batch(
+    ctx,
+    use_original,
+    profile,
+    loglevel,
+    cache_size,
+    trace,
+    render_profile,
+    config_files,
+    with_intro,
+    engine,
+    single_pass,
+    review_copy,
+    threads,
+):
+    """Build several projects, with the jobs of all of them sharing one pool of workers.
+
+    The build graphs of the projects are merged, and each job runs in a
+    worker process, in the directory of its project. The caches are shared
+    by all the projects, and the state of each project is kept in its own
+    .build-state.json, like with build. It is run with batch-videos.py instead:
+
+        batch-videos.py --use-original projects/*.yml
+
+    """
+    start_run(ctx, loglevel, profile, trace)
+    root = os.getcwd()
+    nodes, state_files, cache_size = {}, {}, 0
+    for config_file in config_files:
+        os.chdir(root)
+        config = load_config(config_file, use_original, render_profile, cache_size)
+        config["debug"] = loglevel != "error"
+        if review_copy is not None:
+            config["review_copy"] = review_copy
+        print(f"Loading {config['name']}...")
+        probe_many(params["video"] for clip in config["clips"] for params in clip["timings"])
+        set_intermediate_spec(config)
+        prepare_image_assets(project_image_assets(config))
+        prefetch_screenshots(config["clips"], engine)
+        state_files[f"{config['name']}/"] = os.path.abspath(BUILD_STATE_FILE)
+        project = {
+            "dir": os.getcwd(),
+            "spec": dict(INTERMEDIATE_SPEC),
+            "profile": dict(RENDER_PROFILE),
+        }
+        name = config["name"]
+        for node_name, node in build_graph(config, with_intro, engine, single_pass).items():
+            # The params are copied now, since they refer to the project's settings
+            nodes[f"{name}/{node_name}"] = node._replace(
+                deps=[f"{name}/{dep}" for dep in node.deps],
+                params=copy.deepcopy(node.params),
+                action=functools.partial(run_in_project, project, node.action),
+            )
+        cache_size = max(cache_size, config["cache_size"])
+
+    os.chdir(root)
+    trace = dict(TRACE, events=[] if TRACE["events"] is not None else None, threads={})
+    pool = functools.partial(
+        ProcessPoolExecutor, initializer=start_batch_worker, initargs=(list(FFMPEG_CMD), trace)
+    )
+    run_graph(nodes, threads, state_files=state_files, pool=pool)
+    evict_cache(cache_size)
+
+
 if __name__ == "__main__":
     cli(obj={})